@@ -2,6 +2,11 @@ name = "mongobase"
 
 from mongobase.mongobase import MongoBase, db_context
 from mongobase.modelbase import ModelBase
+from mongobase.querystats import QueryShapeRecorder
+from mongobase.serializer import JSONSerializer
+from mongobase.readahead import ReadAheadIterator
+from mongobase.fields import CompressedField, GridFSField
+from mongobase.materialized import RefreshScheduler
 from mongobase.exceptions import RequiredKeyIsNotSatisfied
 from mongobase.config import *
 
@@ -9,6 +14,12 @@ __all__ = (
     "MongoBase",
     "db_context",
     "ModelBase",
+    "QueryShapeRecorder",
+    "JSONSerializer",
+    "ReadAheadIterator",
+    "CompressedField",
+    "GridFSField",
+    "RefreshScheduler",
     "RequiredKeyIsNotSatisfied",
     "MONGO_DB_URI",
     "MONGO_DB_URI_TEST",
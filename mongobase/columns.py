@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# columns.py
+#
+#
+# COLUMNAR RESULTS:
+# read only some fields of many documents into column buffers
+# instead of creating a ModelBase instance for each document.
+#
+#   int fields (in __structure__) -> array.array('q')
+#   float fields (in __structure__) -> array.array('d')
+#   other fields -> list
+#
+# BASIC USAGE EXAMPLE:
+#
+# columns = Bird.findColumns({'name': 'pigeon'}, ['age', 'weight'])
+# sum(columns['age']) / len(columns['age'])
+#
+# for chunk in Bird.iterColumns({}, ['age', 'weight'], chunk_size=100000):
+#     total += sum(chunk['weight'])  # constant memory
+#
+# Bird.findColumns({}, ['age'], as_numpy=True)  # numpy arrays if numpy is installed
+
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TYPECODES = {
+    int: 'q',
+    float: 'd',
+}
+
+
+class ColumnBuffers(object):
+    """Column buffers for fields of a model.
+
+    A None in a float column is stored as nan.
+    An int column falls back to a list if a value can not be stored
+    in array('q') (e.g. None, float or too large int).
+
+    args:
+        structure (dict): __structure__ of the model.
+        fields (list): keys to be stored.
+    """
+    def __init__(self, structure, fields):
+        self.fields = list(fields)
+        self.columns = {}
+        for field in self.fields:
+            typecode = TYPECODES.get(structure.get(field))
+            self.columns[field] = array(typecode) if typecode else []
+        self.length = 0
+
+    def append(self, document):
+        get = document.get
+        columns = self.columns
+        for field in self.fields:
+            value = get(field)
+            try:
+                columns[field].append(value)
+            except (TypeError, OverflowError):
+                column = columns[field]
+                if value is None and column.typecode == 'd':
+                    column.append(math.nan)
+                else:
+                    columns[field] = list(column)
+                    columns[field].append(value)
+        self.length += 1
+
+    def __len__(self):
+        return self.length
+
+
+def to_numpy(columns):
+    """Convert column buffers to numpy arrays.
+
+    array.array columns are converted without copying.
+    """
+    assert numpy is not None, 'numpy must be installed to use as_numpy=True'
+    converted = {}
+    for field, column in columns.items():
+        if isinstance(column, array):
+            converted[field] = numpy.frombuffer(
+                column, dtype=numpy.int64 if column.typecode == 'q' else numpy.float64)
+        else:
+            # fill an empty array not to create 2d arrays from nested lists
+            converted[field] = numpy.empty(len(column), dtype=object)
+            converted[field][:] = column
+    return converted
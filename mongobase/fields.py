@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# fields.py
+#
+#
+# LAZY FIELDS:
+# field types for large values set in __structure__ instead of a type.
+#
+#    CompressedField(str)  # stored as zlib (or lzma) compressed Binary
+#    GridFSField()  # stored in GridFS. the document has only the reference
+#
+# Values are decoded when the key is accessed (obj.body or obj['body']).
+# Deferred fields are excluded from find() and loaded when accessed
+# from the database the instance was found in.
+#
+# GridFS files are deleted when the value is replaced by update() or findAndUpdateById()
+# and when the document is deleted. updateMany(), bulk_update() and migrate()
+# leave replaced files in GridFS.
+#
+# BASIC USAGE EXAMPLE:
+#
+# class Article(MongoBase):
+#     __collection__ = 'articles'
+#     __structure__ = {
+#         '_id': ObjectId,
+#         'title': str,
+#         'body': CompressedField(str, method='lzma'),
+#         'image': GridFSField(),
+#     }
+#
+# Article({'_id': ObjectId(), 'title': 'a', 'body': long_text, 'image': open('a.png', 'rb')}).save()
+# article = Article.findOne({'title': 'a'})  # body and image are not fetched
+# article.body  # body is fetched and decompressed here
+# article.image.read(1024)  # image is streamed from GridFS by chunks
+
+import lzma
+import zlib
+from bson.binary import Binary
+
+
+class _Deferred(object):
+    """Placeholder of a value not fetched yet."""
+    def __repr__(self):
+        return '<deferred>'
+
+    def __bool__(self):
+        return False
+
+
+DEFERRED = _Deferred()
+
+
+class LazyField(object):
+    """Base class of field types decoded when accessed.
+
+    args:
+        value_type (type): the type of decoded values.
+        deferred (bool): exclude from find() and fetch when accessed if True.
+    """
+    cache = True  # keep the decoded value in the instance
+
+    def __init__(self, value_type, deferred=False):
+        self.value_type = value_type
+        self.deferred = deferred
+
+    def isEncoded(self, value):
+        """Return True if value is in the stored format."""
+        raise NotImplementedError
+
+    def encode(self, value):
+        """Return value in the stored format. (called by purify())"""
+        return value
+
+    def decode(self, obj, key, value):
+        """Return the decoded value of obj[key]."""
+        raise NotImplementedError
+
+    def jsonValue(self, obj, key):
+        """Return the value used by serialize() and serializeMany().
+
+        Deferred values are not fetched (None) and fetched values are decoded in memory.
+        """
+        value = dict.get(obj, key)
+        if value is DEFERRED:
+            return None
+        if self.isEncoded(value):
+            return self.decode(obj, key, value)
+        return value
+
+    def validate(self, value):
+        return value is None or value is DEFERRED \
+            or isinstance(value, self.value_type) or self.isEncoded(value)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, self.value_type.__name__)
+
+
+class CompressedField(LazyField):
+    """Field stored as compressed bson Binary.
+
+    args:
+        value_type (type): str or bytes.
+        method (str): 'zlib' or 'lzma'.
+        level (int): compression level. default level of the method if None.
+        deferred (bool): exclude from find() and fetch when accessed.
+    """
+    SUBTYPES = {'zlib': 0x80, 'lzma': 0x81}  # user defined bson binary subtypes
+
+    def __init__(self, value_type=str, method='zlib', level=None, deferred=True):
+        assert value_type in (str, bytes), 'value_type must be either str or bytes'
+        assert method in self.SUBTYPES, 'method must be either zlib or lzma'
+        super().__init__(value_type, deferred=deferred)
+        self.method = method
+        self.level = level
+
+    def isEncoded(self, value):
+        return isinstance(value, Binary) and value.subtype in self.SUBTYPES.values()
+
+    def encode(self, value):
+        if value is None or value is DEFERRED or self.isEncoded(value):
+            return value
+        data = value.encode('utf-8') if isinstance(value, str) else bytes(value)
+        if self.method == 'zlib':
+            compressed = zlib.compress(data, -1 if self.level is None else self.level)
+        else:
+            compressed = lzma.compress(data, preset=self.level)
+        return Binary(compressed, self.SUBTYPES[self.method])
+
+    def decode(self, obj, key, value):
+        if value is DEFERRED:
+            value = obj.loadFields([key])._rawValue(key)
+        if not self.isEncoded(value):
+            return value
+        if value.subtype == self.SUBTYPES['zlib']:
+            data = zlib.decompress(value)
+        else:
+            data = lzma.decompress(value)
+        return data.decode('utf-8') if self.value_type is str else data
+
+
+class GridFSField(LazyField):
+    """Field stored in GridFS.
+
+    Set bytes or a readable file-like object. The document keeps only
+    {'gridfs_id': file_id} and the access returns a file-like GridOut
+    which reads the content by chunks.
+
+    args:
+        bucket_name (str): the GridFS bucket name.
+        chunk_size (int): chunk size in bytes. the default of GridFS if None.
+    """
+    cache = False  # a new stream is opened for each access
+
+    def __init__(self, bucket_name='fs', chunk_size=None):
+        super().__init__(bytes)
+        self.bucket_name = bucket_name
+        self.chunk_size = chunk_size
+
+    def isEncoded(self, value):
+        return isinstance(value, dict) and 'gridfs_id' in value
+
+    def validate(self, value):
+        return super().validate(value) or hasattr(value, 'read')
+
+    def upload(self, bucket, key, value):
+        """Upload value to GridFS and return the reference."""
+        options = {'chunk_size_bytes': self.chunk_size} if self.chunk_size else {}
+        return {'gridfs_id': bucket.upload_from_stream(key, value, **options)}
+
+    def decode(self, obj, key, value):
+        if not self.isEncoded(value):
+            return value
+        return obj.openGridFS(key)
+
+    def jsonValue(self, obj, key):
+        value = dict.get(obj, key)
+        return str(value['gridfs_id']) if self.isEncoded(value) else None
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.bucket_name)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# materialized.py
+#
+#
+# MATERIALIZED AGGREGATIONS:
+# a summary model keeps results of a pipeline over a source model
+# refreshed by $merge. (MongoDB 4.2+)
+#
+# BASIC USAGE EXAMPLE:
+#
+# class BirdStats(MongoBase):
+#     __collection__ = 'bird_stats'
+#     __structure__ = {'_id': str, 'count': int, 'average_age': float}
+#     __materialized__ = {
+#         'source': Bird,
+#         'pipeline': [{'$group': {'_id': '$name', 'count': {'$sum': 1}, 'average_age': {'$avg': '$age'}}}],
+#         'group_key': 'name',  # only groups of changed documents are recomputed
+#     }
+#
+# BirdStats.refresh()  # full at the first time, then incremental over documents whose 'updated' is past the watermark
+# BirdStats.refresh(full=True)  # recompute everything and remove stale results
+# scheduler = BirdStats.scheduleRefresh(60)  # refresh every 60 seconds
+# BirdStats.find({'count': {'$gt': 10}})  # cheap reads
+# scheduler.stop()
+
+import datetime
+import logging
+import threading
+
+WATERMARK_COLLECTION = 'mongobase_materialized'
+
+DEFAULT_SPEC = {
+    'pipeline': [],
+    'group_key': None,  # source key of the summary _id. required to aggregate incrementally
+    'timestamp_key': 'updated',  # source key compared with the watermark
+    'when_matched': 'replace',  # whenMatched of $merge
+    'incremental': True,
+    'watermark_lag': datetime.timedelta(seconds=5),  # overlap for late writes and clock skew
+    'remove_stale': True,  # remove results not refreshed by a full refresh
+}
+
+# stages aggregating many documents into one. group_key is required for them
+AGGREGATING_STAGES = ('$group', '$bucket', '$bucketAuto', '$count', '$sortByCount', '$facet')
+
+
+class RefreshScheduler(object):
+    """Call refresh every interval seconds in a background thread.
+
+    args:
+        refresh (function): called with no argument.
+        interval (float): seconds between refreshes.
+    """
+    def __init__(self, refresh, interval):
+        self._refresh = refresh
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self._refresh()
+            except Exception as e:
+                logging.exception('refresh failed: {}'.format(e))
+
+    def stop(self):
+        """Stop refreshing. A running refresh is waited for."""
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# migration.py
+#
+#
+# ONLINE MIGRATION:
+# recompute fields of existing documents in _id order by batches.
+# progress is saved in the checkpoint collection to resume after interruption.
+#
+# BASIC USAGE EXAMPLE:
+#
+# Bird.migrate(
+#     'add_age_group',  # the name of the migration
+#     lambda bird: {'age_group': bird.age // 10},  # fields to $set (None to skip)
+#     query={'age_group': None},
+#     batch_size=1000,
+#     max_rate=5000,  # documents per second
+#     max_replication_lag=10,  # seconds
+#     n_partitions=4)  # partitions migrated concurrently
+
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+from pymongo.operations import UpdateOne
+from .throttle import RateLimiter
+
+CHECKPOINT_COLLECTION = 'mongobase_migrations'
+
+
+def replication_lag(client):
+    """Return the replication lag in seconds of the slowest secondary.
+
+    returns 0 if the server is not a member of a replica set.
+    """
+    try:
+        status = client.admin.command('replSetGetStatus')
+    except OperationFailure:
+        return 0
+    primary = [member['optimeDate'] for member in status['members']
+               if member['stateStr'] == 'PRIMARY']
+    secondaries = [member['optimeDate'] for member in status['members']
+                   if member['stateStr'] == 'SECONDARY']
+    if not primary or not secondaries:
+        return 0
+    return max(0, (primary[0] - min(secondaries)).total_seconds())
+
+
+class MigrationRunner(object):
+    """Apply a transform to documents of a collection by batches in _id order.
+
+    args:
+        collection (pymongo Collection): documents to migrate. decoded as instances if configured.
+        name (str): the name of the migration. used as the checkpoint key.
+        transform (function): transform(document) returns fields to $set,
+            update operators or None to skip the document.
+        prepare (function): prepare(update) returns an update document for pymongo.
+            (MongoBase passes its update preparation to validate and maintain 'updated')
+        hydrate (function): hydrate(documents) returns instances passed to transform.
+            (MongoBase passes generateInstances to fill keys missing in documents)
+        query (dict): documents to migrate. (optional)
+        batch_size (int): # of documents read and written at once.
+        max_rate (float): max # of documents per second in total. (optional)
+        max_replication_lag (float): wait while secondaries are behind more than
+            these seconds. (optional)
+        n_partitions (int): # of _id partitions migrated concurrently.
+    """
+    def __init__(self, collection, name, transform, prepare=None, hydrate=None, query=None,
+                 batch_size=1000, max_rate=None, max_replication_lag=None, n_partitions=1):
+        self.collection = collection
+        self.name = name
+        self.transform = transform
+        self.prepare = prepare if prepare else lambda update: {'$set': update}
+        self.hydrate = hydrate if hydrate else list
+        self.query = query if query else {}
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.max_replication_lag = max_replication_lag
+        self.n_partitions = n_partitions
+        self.checkpoints = collection.database[CHECKPOINT_COLLECTION]
+        self._lock = threading.Lock()
+        self._lag = 0
+        self._lag_checked = 0
+        self._n_running = 1
+
+    def _checkpoint_id(self, partition):
+        return '{}:{}:{}'.format(self.collection.name, self.name, partition)
+
+    def _partitions(self):
+        """Return checkpoints of partitions, created if not exist.
+
+        Partitions are split by $bucketAuto on _id and saved
+        so that resumed runs use the same boundaries.
+        """
+        saved = list(self.checkpoints.find(
+            {'collection': self.collection.name, 'migration': self.name}).sort('partition', ASCENDING))
+        if saved:
+            return saved
+        bounds = [None]
+        if self.n_partitions > 1:
+            buckets = list(self.collection.aggregate([
+                {'$project': {'_id': 1}},
+                {'$bucketAuto': {'groupBy': '$_id', 'buckets': self.n_partitions}}]))
+            bounds += [bucket['_id']['min'] for bucket in buckets[1:]]
+        bounds.append(None)
+        checkpoints = [{
+            '_id': self._checkpoint_id(i),
+            'collection': self.collection.name,
+            'migration': self.name,
+            'partition': i,
+            'low': bounds[i],
+            'high': bounds[i + 1],
+            'last_id': None,
+            'count': 0,
+            'done': False,
+        } for i in range(len(bounds) - 1)]
+        self.checkpoints.insert_many(checkpoints)
+        return checkpoints
+
+    def _wait_for_replication(self):
+        """Sleep while the replication lag is over max_replication_lag."""
+        if not self.max_replication_lag:
+            return
+        while True:
+            with self._lock:
+                # check the lag once in a second at most for all partitions
+                if time.monotonic() - self._lag_checked >= 1:
+                    self._lag = replication_lag(self.collection.database.client)
+                    self._lag_checked = time.monotonic()
+                lag = self._lag
+            if lag <= self.max_replication_lag:
+                return
+            logging.info('migration {} waits for replication lag: {}s'.format(self.name, lag))
+            time.sleep(1)
+
+    def _run_partition(self, checkpoint):
+        # max_rate is shared by running partitions
+        limiter = RateLimiter(self.max_rate / self._n_running if self.max_rate else None)
+        last_id = checkpoint['last_id']
+        count = checkpoint['count']
+        while True:
+            id_condition = {'$gte': checkpoint['low']} if checkpoint['low'] is not None else {}
+            if last_id is not None:
+                id_condition = {'$gt': last_id}
+            if checkpoint['high'] is not None:
+                id_condition['$lt'] = checkpoint['high']
+            query = {'$and': [self.query, {'_id': id_condition}]} if id_condition else self.query
+            documents = list(self.collection.find(query)
+                             .sort('_id', ASCENDING).limit(self.batch_size))
+            if not documents:
+                break
+            requests = []
+            for document in self.hydrate(documents):
+                update = self.transform(document)
+                if update:
+                    requests += [UpdateOne({'_id': document['_id']}, self.prepare(update))]
+            if requests:
+                self.collection.bulk_write(requests, ordered=False)
+            last_id = documents[-1]['_id']
+            count += len(documents)
+            self.checkpoints.update_one({'_id': checkpoint['_id']}, {'$set': {
+                'last_id': last_id,
+                'count': count,
+                'updated': datetime.datetime.now(datetime.timezone.utc)}})
+            logging.info('migration {} partition {}: {} documents (last _id: {})'.format(
+                self.name, checkpoint['partition'], count, last_id))
+            limiter.wait(len(documents))
+            self._wait_for_replication()
+        self.checkpoints.update_one({'_id': checkpoint['_id']}, {'$set': {
+            'done': True,
+            'updated': datetime.datetime.now(datetime.timezone.utc)}})
+        return count
+
+    def run(self, restart=False):
+        """Run or resume the migration.
+
+        args:
+            restart (bool): discard saved checkpoints and start from the beginning.
+
+        returns:
+            count (int): # of documents processed in all partitions including resumed ones.
+        """
+        if restart:
+            self.reset()
+        checkpoints = self._partitions()
+        pending = [checkpoint for checkpoint in checkpoints if not checkpoint['done']]
+        count = sum(checkpoint['count'] for checkpoint in checkpoints if checkpoint['done'])
+        if pending:
+            self._n_running = len(pending)
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                count += sum(executor.map(self._run_partition, pending))
+        return count
+
+    def reset(self):
+        """Remove checkpoints of this migration."""
+        self.checkpoints.delete_many(
+            {'collection': self.collection.name, 'migration': self.name})
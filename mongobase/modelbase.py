@@ -13,6 +13,8 @@
 #    __default_values__ = {}  # set default values to some keys
 #    __validators__ = {}  # set pairs like key: validatefunc()
 #
+#    a LazyField (e.g. CompressedField(str)) can be set instead of a type in __structure__.
+#
 # BASIC USAGE EXAMPLE:
 #
 # animal_name = 'wild boar'
@@ -24,12 +26,29 @@
 # cat.validate()  # check types in __structure__ and run __validators__
 # cat.purify()  # convert to dict
 # cat.serialize()  # convert to json compatible dict
+# Animal.serializeMany([cat, dog])  # convert many instances to json bytes
 # cat._is_required_fields_satisfied()  # raise RequiredKeyIsNotSatisfied if not enough
 
 import logging
 import datetime
 import sys
 from .exceptions import RequiredKeyIsNotSatisfied
+from .serializer import JSONSerializer
+from .fields import LazyField, DEFERRED
+
+
+def _plain(value):
+    """Return value with embedded documents decoded as a model class converted to dicts.
+
+    Lists are converted in place and other values are returned as they are.
+    """
+    if isinstance(value, ModelBase):
+        return {key: _plain(item) for key, item in dict.items(value)}
+    if isinstance(value, list):
+        for i, item in enumerate(value):
+            if isinstance(item, (ModelBase, list)):
+                value[i] = _plain(item)
+    return value
 
 
 class ModelBase(dict):
@@ -40,12 +59,43 @@ class ModelBase(dict):
     __validators__ = {}  # set pairs like key: validatefunc()
     # __search_text_keys__ = []  # set index keys for text search
 
+    __lazy_fields__ = {}  # LazyField in __structure__. set automatically
+
     # attributed dictionary extension
     # obj['foo'] <-> obj.foo
     __getattr__ = dict.__getitem__
     __setattr__ = dict.__setitem__
 
-    def __init__(self, init_dict):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.__lazy_fields__ = {
+            key: declared for key, declared in cls.__structure__.items()
+            if isinstance(declared, LazyField)}
+        if cls.__lazy_fields__:
+            # decode lazy fields when accessed
+            cls.__getitem__ = ModelBase._lazy_getitem
+            cls.__getattr__ = ModelBase._lazy_getitem
+
+    def _lazy_getitem(self, key):
+        """dict.__getitem__() decoding LazyField values."""
+        value = dict.__getitem__(self, key)
+        field = self.__lazy_fields__.get(key)
+        if field is None or not (value is DEFERRED or field.isEncoded(value)):
+            return value
+        decoded = field.decode(self, key, value)
+        if field.cache:
+            dict.__setitem__(self, key, decoded)
+        return decoded
+
+    def _rawValue(self, key):
+        """Return the value without decoding LazyField."""
+        return dict.get(self, key)
+
+    def __init__(self, init_dict=None):
+        if init_dict is None:
+            # called with no argument by the BSON decoder (CodecOptions.document_class).
+            # keys are set by the decoder, then _fill_defaults() is called.
+            return
         # set properties written in __structure__
         for key in self.__structure__:
             if key in init_dict and init_dict[key] is not None:
@@ -58,6 +108,33 @@ class ModelBase(dict):
                 default_val = None
             setattr(self, key, default_val)
 
+    def _fill_defaults(self):
+        """Set defaults to keys in __structure__ which are missing or None.
+
+        Same as __init__() but in place. Keys not in __structure__
+        (e.g. search_text) are removed like __init__() ignores them.
+        The BSON decoder builds embedded documents as this class too,
+        so they are converted to dicts as other methods return.
+
+        returns:
+            self (ModelBase)
+        """
+        extra_keys = [key for key in dict.keys(self) if key not in self.__structure__]
+        for key in extra_keys:
+            dict.__delitem__(self, key)
+        for key in self.__structure__:
+            value = dict.get(self, key)
+            if value is None:
+                field = self.__lazy_fields__.get(key)
+                if field is not None and field.deferred and key not in self:
+                    # excluded from the query. fetched when accessed
+                    dict.__setitem__(self, key, DEFERRED)
+                else:
+                    dict.__setitem__(self, key, self.__default_values__.get(key))
+            elif isinstance(value, (ModelBase, list)):
+                dict.__setitem__(self, key, _plain(value))
+        return self
+
     def getattr(self, key):
         return getattr(self, key)
 
@@ -72,9 +149,16 @@ class ModelBase(dict):
         """
         extracted = {}
         for key in self.__structure__:
-            extracted[key] = self[key]
+            field = self.__lazy_fields__.get(key)
+            if field is None:
+                extracted[key] = self[key]
+            elif dict.get(self, key) is not DEFERRED:
+                # not fetched deferred fields are not written
+                extracted[key] = field.encode(dict.get(self, key))
         if 'search_text' in self:
             extracted['search_text'] = self['search_text']
+        if 'search_tokens' in self:
+            extracted['search_tokens'] = self['search_tokens']
         # if self.__search_text_keys__:
         #     extracted.update({'search_text': self['search_text']})
         return extracted
@@ -83,33 +167,90 @@ class ModelBase(dict):
         """Return the json formatted dict.
 
         1. datetime.datetime -> YYYY/mm/dd/HH/MM/SS
+        2. LazyField -> LazyField.jsonValue() (deferred values are not fetched)
 
         returns:
             object (dict): pure json format dict
         """
         extracted = {}
         for key in self.__structure__:
-            extracted[key] = datetime.datetime.strftime(self[key], '%Y/%m/%d/%H/%M/%S')\
-                if isinstance(self[key], datetime.datetime) else self[key]
+            field = self.__lazy_fields__.get(key)
+            value = field.jsonValue(self, key) if field is not None else self[key]
+            extracted[key] = datetime.datetime.strftime(value, '%Y/%m/%d/%H/%M/%S')\
+                if isinstance(value, datetime.datetime) else value
         return extracted
 
-    def validate(self, target=None):
+    @classmethod
+    def jsonSerializer(cls):
+        """Return the JSONSerializer compiled from __structure__ of this class.
+
+        The serializer is created once for each class.
+        """
+        serializer = cls.__dict__.get('_json_serializer')
+        if serializer is None:
+            serializer = JSONSerializer(cls)
+            cls._json_serializer = serializer
+        return serializer
+
+    @classmethod
+    def serializeMany(cls, instances, fp=None, encoders=None, chunk_size=1000):
+        """Return json bytes of many instances in one pass.
+
+        Faster equivalent of json.dumps([obj.serialize() for obj in instances]).
+
+        args:
+            instances (iterable): instances of this class (or dicts).
+            fp (file-like object): write to fp instead of returning bytes. (optional)
+            encoders (dict): pairs like type: func(value) to encode
+                datetime, ObjectId, Decimal128, etc. (optional)
+
+        returns:
+            json (bytes) or written bytes (int) if fp is given.
+        """
+        serializer = JSONSerializer(cls, encoders=encoders) if encoders\
+            else cls.jsonSerializer()
+        if fp is not None:
+            return serializer.dump(instances, fp, chunk_size=chunk_size)
+        return serializer.encode(instances)
+
+    def validate(self, target=None, keys=None):
         """Validate properties usually before inserted or updated.
 
         1. validate values according to rules written in the __validators__
         2. validate values according to types written in the __structure__
 
+        args:
+            target (dict): validate target instead of self. (optional)
+            keys (iterable): validate only these keys. (optional)
+
         returns:
             result (bool): True if no error occured.
         """
         if target is None:
             target = self
+        keys = None if keys is None else set(keys)
         # validate values according to rules in the __validators__
         for name in self.__validators__:
+            if keys is not None and name not in keys:
+                continue
+            if target.get(name) is DEFERRED:
+                continue
+            if name in self.__lazy_fields__ and name not in target:
+                # deferred fields not fetched are not in purify()
+                continue
             logging.info(u'VALIDATE {}'.format(name))
             assert self.__validators__[name](target[name])
         # validate values according to types written in the __structure__
         for key in self.__structure__:
+            if keys is not None and key not in keys:
+                continue
+            declared = self.__structure__[key]
+            if isinstance(declared, LazyField):
+                if not declared.validate(target.get(key)):
+                    raise TypeError(
+                        'the key \'{}\' must be of type {} but {}'
+                        .format(key, declared, type(target.get(key))))
+                continue
             if not (isinstance(target[key], self.__structure__[key])
                     or target[key] is None):
                 if not key == '_id':
@@ -129,7 +270,8 @@ class ModelBase(dict):
             satisfied (bool): True if all fields have a value.
         """
         for key in self.__required_fields__:
-            if getattr(self, key) is None:
+            # deferred values are not fetched to check
+            if dict.get(self, key) is None:
                 raise RequiredKeyIsNotSatisfied(
                     'the key \'{}\' must not be None'.format(key)
                     )
@@ -141,6 +283,10 @@ class ModelBase(dict):
         """Return this instances converted from dicts in documents.
 
         Convert dict objects to this instance and return them.
+        Documents already decoded as this class are completed in place.
         """
         for obj in documents:
-            yield cls(obj)
\ No newline at end of file
+            if obj.__class__ is cls:
+                yield obj._fill_defaults()
+            else:
+                yield cls(obj)
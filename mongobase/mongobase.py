@@ -16,7 +16,14 @@
 #    __validators__ = {}  #  pairs like key: validatefunc()
 #    __search_text_keys__ = []  #  keys for text search
 #    __search_text_index_unit__ = ''  #  split unit for text search
-#    __indexes__ = []  #  index list
+#    __search_text_index_mode__ = ''  #  'text' ($text on search_text) or 'tokens' (search_tokens array)
+#    __indexes__ = []  #  index list. {'keys': [..], **options} for options like expireAfterSeconds
+#    __references__ = {}  #  pairs like key: MongoBase subclass referenced by _id
+#    __bucket__ = None  #  {'time_key': .., 'meta_key': .., 'granularity': timedelta} to store in buckets
+#    __materialized__ = None  #  {'source': MongoBase subclass, 'pipeline': [..]} for summary models
+#    __query_recorder__ = None  #  QueryShapeRecorder to record query shapes
+#    __decode_as_instance__ = True  #  decode find results directly into instances
+#    __type_codecs__ = []  #  bson TypeCodec instances for custom field types
 #
 #
 # Interface:
@@ -29,26 +36,58 @@
 #   - findAndUpdateById(cls, _id, updates) [Class method]
 #
 # 3. find methods
-#   - find(cls, query, limit=None, skip=None, sort=None) [Class method]
+#   - find(cls, query, limit=None, skip=None, sort=None, prefetch=None) [Class method]
 #   - findOne(cls, query) [Class method]
 #   - findAll(cls) [Class method]
-#   - findInRanges(cls, ranges_dict, limit, skip, sort) [Class method]
+#   - findInRanges(cls, ranges_dict, limit, skip, sort, n_splits) [Class method]
+#   - findColumns(cls, query, fields, limit, skip, sort) [Class method]
+#   - iterColumns(cls, query, fields, chunk_size) [Class method]
 #   - textSearch(cls, text, limit, skip) [Class method]
+#   - migrateSearchTokens(cls, batch_size) [Class method]
 #   - distinct(key) [Class method]
+#   - prefetch(cls, instances, keys) [Class method]
+#   - related(self, key) [Instance method]
 #
 #   - count(cls) [Class method]
 #   - remove(cls, query) [Class method]
+#   - purge(cls, query, batch_size, max_rate) [Class method]
+#   - migrate(cls, name, transform, query, batch_size, max_rate) [Class method]
 #   - incrementalId(cls) [Class method]
+#   - loadFields(self, keys) [Instance method]
+#   - openGridFS(self, key) [Instance method]
+#
+# 4. index methods
+#   - createIndexes(cls, db=None, indexes=None) [Class method]
+#   - adviseIndexes(cls, top, create) [Class method]
+#
+# 5. materialized aggregation methods
+#   - refresh(cls, full) [Class method]
+#   - scheduleRefresh(cls, interval, full) [Class method]
 #
 
 
 import csv
 import datetime
+import functools
+import heapq
 import logging
 import inspect
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import TEXT, MongoClient, ReturnDocument, DESCENDING, ASCENDING
 from pymongo.operations import InsertOne, ReplaceOne, UpdateOne, UpdateMany
+from pymongo.errors import OperationFailure
+from bson.codec_options import CodecOptions, TypeRegistry
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
 from .modelbase import ModelBase
+from .exceptions import RequiredKeyIsNotSatisfied
+from .fields import GridFSField, DEFERRED
+from .querystats import plan_issues, suggest_index, is_covered
+from .columns import ColumnBuffers, to_numpy
+from .throttle import RateLimiter
+from .readahead import ReadAheadIterator
+from .migration import MigrationRunner
+from .materialized import WATERMARK_COLLECTION, DEFAULT_SPEC, AGGREGATING_STAGES, RefreshScheduler
 from .config import MONGO_DB_URI, MONGO_DB_URI_TEST, MONGO_DB_NAME, MONGO_DB_NAME_TEST,\
     MONGO_DB_CONNECT_TIMEOUT_MS, MONGO_DB_SERVER_SELECTION_TIMEOUT_MS,\
     MONGO_DB_SOCKET_TIMEOUT_MS, MONGO_DB_SOCKET_KEEP_ALIVE,\
@@ -103,10 +142,27 @@ class MongoBase(ModelBase):
     # __required_fields__ = []  # lists required keys
     # __default_values__ = {}  # set default values to some keys
     # __validators__ = {}  # set pairs like key: validatefunc()
-    __indexes__ = []  # set index for any key.
+    __indexes__ = []  # set index for any key. {'keys': [..], 'expireAfterSeconds': n} for TTL index
+    __references__ = {}  # pairs like key: MongoBase subclass. the key holds _id (or list of _id) of it
+    # store instances in time buckets if set. (time series mode)
+    # {'time_key': 'measured',  # datetime key in __structure__
+    #  'meta_key': 'sensor_id',  # key of the entity (optional)
+    #  'granularity': datetime.timedelta(hours=1),  # time window of a bucket
+    #  'max_count': 1000}  # max # of instances in a bucket (optional)
+    __bucket__ = None
+    # keep results of a pipeline over a source model refreshed by $merge if set. (summary model)
+    # {'source': Bird,  # MongoBase subclass
+    #  'pipeline': [{'$group': {'_id': '$name', 'count': {'$sum': 1}}}],
+    #  'group_key': 'name'}  # source key of the summary _id (optional)
+    # see materialized.py for other options.
+    __materialized__ = None
     __search_text_keys__ = []  # index keys for text search. [('key', weight(int)),..] if weighted_type is 'weighted'
     __search_text_index_unit__ = 'bigram'  # either bigram or morpheme
     __search_text_weight_type__ = 'uniform'  # designate weights to each text index key if 'weighted'
+    __search_text_index_mode__ = 'text'  # 'text': $text index on search_text. 'tokens': multikey index on search_tokens
+    __query_recorder__ = None  # set a QueryShapeRecorder to record query shapes
+    __decode_as_instance__ = True  # BSON decoder builds instances of this class directly
+    __type_codecs__ = []  # bson.codec_options.TypeCodec instances for custom field types
 
     # NOTE: remove comment out when you use in the specific case for japanese
     # __search_text_index_with_unigram__ = False  # add unigram to the index if True
@@ -127,7 +183,7 @@ class MongoBase(ModelBase):
             waitQueueTimeoutMS=MONGO_DB_WAIT_QUEUE_TIMEOUT_MS
         )[__db_name__]
 
-    def __init__(self, init_dict):
+    def __init__(self, init_dict=None):
         super().__init__(init_dict)
 
     @classmethod
@@ -151,6 +207,45 @@ class MongoBase(ModelBase):
         db_name = db_name if db_name else cls.__db_name__
         return cls._client()[db_name]
 
+    @classmethod
+    def codecOptions(cls, document_class=None):
+        """Return CodecOptions to decode documents of this collection.
+
+        args:
+            document_class (type): this class if None.
+
+        The options are created once for each class and document_class.
+        """
+        document_class = document_class if document_class else cls
+        cache = cls.__dict__.get('_codec_options')
+        if cache is None:
+            cache = {}
+            cls._codec_options = cache
+        if document_class not in cache:
+            cache[document_class] = CodecOptions(
+                document_class=document_class,
+                type_registry=TypeRegistry(cls.__type_codecs__))
+        return cache[document_class]
+
+    @classmethod
+    def _collection(cls, db=None, as_instance=False):
+        """Return the pymongo collection of this class.
+
+        args:
+            as_instance (bool): if True and __decode_as_instance__ is set,
+                the BSON decoder builds instances of this class directly
+                (via CodecOptions.document_class) instead of dicts.
+                Embedded documents are decoded as this class as well
+                and converted back to dicts by _fill_defaults().
+        """
+        __db = db if db else cls.__db
+        collection = __db[cls.__collection__]
+        if as_instance and cls.__decode_as_instance__:
+            return collection.with_options(codec_options=cls.codecOptions())
+        if cls.__type_codecs__:
+            return collection.with_options(codec_options=cls.codecOptions(dict))
+        return collection
+
     @classmethod
     def set_test_db_client(cls, test_db_uri, test_db_name):
         """Set Test MongoDB.
@@ -172,6 +267,8 @@ class MongoBase(ModelBase):
         MongoBase.__db = cls._client(MONGO_DB_URI)[MONGO_DB_NAME]
 
     def save(self, db=None):
+        if self.__bucket__:
+            return self.__insertIntoBuckets([self], db=db) and self
         return self.insertIfNotExistsWithKeys('_id', db=db)
 
     def update(self, db=None):
@@ -181,18 +278,147 @@ class MongoBase(ModelBase):
         return self.deleteById(self._id, db=db)
 
     @classmethod
-    def find(cls, query: dict, limit=None, skip=None, sort=None, returns_generator=False, db=None, **kwargs) -> list:
+    def find(cls, query: dict, limit=None, skip=None, sort=None, returns_generator=False, db=None,
+             prefetch=None, prefetch_lookup=False, prefetch_batch_size=1000, read_ahead=None,
+             **kwargs) -> list:
         """Find and return instances.
 
+        args:
+            prefetch (list): keys in __references__ to load with the results.
+                referenced instances are available by related(key). (optional)
+            prefetch_lookup (bool): load them by $lookup in one aggregation
+                instead of one $in query for each key. (optional)
+            prefetch_batch_size (int): # of results prefetched at once
+                if returns_generator is True.
+            read_ahead (int): # of batches fetched and converted to instances
+                ahead of the consumer by a background thread.
+                the size of batches is batch_size (1000 if not set). (optional)
+
         returns:
             objects (list):  ModelBase instances if found else None.
         """
-        results = cls.__find(
-            query, limit=limit, skip=skip, sort=sort, db=db, **kwargs)
+        if read_ahead:
+            kwargs.setdefault('batch_size', 1000)
+        if prefetch and prefetch_lookup:
+            assert not set(kwargs) - {'batch_size'}, f'{list(kwargs)} can not be used with prefetch_lookup.'
+            instances = cls.__findWithLookup(
+                query, prefetch, limit=limit, skip=skip, sort=sort, db=db,
+                batch_size=kwargs.get('batch_size'))
+        else:
+            results = cls.__find(
+                query, limit=limit, skip=skip, sort=sort, db=db, **kwargs)
+            instances = cls.generateInstances(results, db=db)
+            if prefetch:
+                instances = cls.__prefetchInBatches(instances, prefetch, prefetch_batch_size, db=db)
+        if read_ahead:
+            instances = ReadAheadIterator(
+                instances, batch_size=kwargs['batch_size'], max_batches=read_ahead)
         if returns_generator:
-            return cls.generateInstances(results)
+            return instances
         else:
-            return list(cls.generateInstances(results))
+            return list(instances)
+
+    @classmethod
+    def prefetch(cls, instances, keys, db=None):
+        """Load referenced instances of keys for all instances at once.
+
+        One $in query is performed for each key in __references__
+        instead of one findOne for each instance and key.
+
+        args:
+            instances (list): instances of this class.
+            keys (list): keys in __references__.
+
+        returns:
+            instances (list): the same instances. referenced instances are
+                available by related(key).
+        """
+        instances = list(instances)
+        for key in keys:
+            model = cls.__references__[key]
+            ids = set()
+            for obj in instances:
+                value = obj.get(key)
+                if isinstance(value, list):
+                    ids.update(value)
+                elif value is not None:
+                    ids.add(value)
+            related = {obj._id: obj for obj in model.find(
+                {'_id': {'$in': list(ids)}}, db=db)} if ids else {}
+            for obj in instances:
+                value = obj.get(key)
+                if isinstance(value, list):
+                    obj.__setRelated(key, [related[_id] for _id in value if _id in related])
+                else:
+                    obj.__setRelated(key, related.get(value))
+        return instances
+
+    def related(self, key, db=None):
+        """Return referenced instances of key in __references__.
+
+        Prefetched instances are returned if loaded by find(prefetch=[..])
+        otherwise they are loaded now.
+
+        returns:
+            instance (MongoBase) or instances (list) if the key holds list of _id.
+        """
+        if key not in self.__dict__.get('_related', {}):
+            self.prefetch([self], [key], db=db)
+        return self.__dict__['_related'][key]
+
+    def __setRelated(self, key, value):
+        # kept as an instance attribute, not a dict item,
+        # so that it is not written to db or serialized
+        self.__dict__.setdefault('_related', {})[key] = value
+
+    @classmethod
+    def __prefetchInBatches(cls, instances, keys, batch_size, db=None):
+        """Prefetch references of instances from a generator batch by batch."""
+        batch = []
+        for obj in instances:
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                yield from cls.prefetch(batch, keys, db=db)
+                batch = []
+        if batch:
+            yield from cls.prefetch(batch, keys, db=db)
+
+    @classmethod
+    def __findWithLookup(cls, query, keys, limit=None, skip=None, sort=None, db=None,
+                         batch_size=None):
+        """Find and load referenced instances of keys by $lookup in one aggregation.
+
+        Referenced collections must be in the same database.
+        """
+        __db = db if db else cls.__db
+        cls.__recordQuery('find', query, sort)
+        pipeline = [{'$match': query}]
+        if sort:
+            pipeline.append({'$sort': dict([(sort, ASCENDING)] if isinstance(sort, str) else sort)})
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        for key in keys:
+            pipeline.append({'$lookup': {
+                'from': cls.__references__[key].__collection__,
+                'localField': key,
+                'foreignField': '_id',
+                'as': '_related.' + key}})
+        for document in cls._collection(__db, as_instance=True).aggregate(
+                pipeline, batchSize=batch_size):
+            # taken before keys not in __structure__ are removed
+            looked_up = dict.pop(document, '_related', {})
+            obj = next(cls.generateInstances([document], db=db))
+            for key in keys:
+                model = cls.__references__[key]
+                related = {document['_id']: model(document) for document in looked_up.get(key, [])}
+                value = obj.get(key)
+                if isinstance(value, list):
+                    obj.__setRelated(key, [related[_id] for _id in value if _id in related])
+                else:
+                    obj.__setRelated(key, related.get(value))
+            yield obj
 
     @classmethod
     def findOne(cls, query, db=None, *args, **kwargs):
@@ -202,9 +428,15 @@ class MongoBase(ModelBase):
             object (ModelBase): a ModelBase instance if found else None.
         """
         __db = db if db else cls.__db
-        result = __db[cls.__collection__].find_one(query, *args, **kwargs)
+        if cls.__bucket__:
+            results = cls.find(query, limit=1, sort=kwargs.get('sort'), db=__db)
+            return results[0] if results else None
+        cls.__recordQuery('findOne', query, kwargs.get('sort'))
+        if not args and 'projection' not in kwargs and cls.__deferredProjection():
+            kwargs['projection'] = cls.__deferredProjection()
+        result = cls._collection(__db, as_instance=True).find_one(query, *args, **kwargs)
         if result:
-            return cls(result)
+            return next(cls.generateInstances([result], db=db))
         else:
             return None
 
@@ -216,8 +448,296 @@ class MongoBase(ModelBase):
             objects (list): ModelBase instances if found else None.
         """
         __db = db if db else cls.__db
-        results = __db[cls.__collection__].find()
-        return list(cls.generateInstances(results))
+        if cls.__bucket__:
+            return list(cls.generateInstances(cls.__findInBuckets({}, db=__db), db=db))
+        results = cls._collection(__db, as_instance=True).find(
+            projection=cls.__deferredProjection())
+        return list(cls.generateInstances(results, db=db))
+
+    @classmethod
+    def __deferredProjection(cls):
+        """Return the projection excluding deferred fields or None if no deferred field.
+
+        Deferred fields are fetched when accessed. (see fields.py)
+        """
+        if not cls.__decode_as_instance__:
+            return None
+        projection = {key: 0 for key, field in cls.__lazy_fields__.items() if field.deferred}
+        return projection if projection else None
+
+    @classmethod
+    def generateInstances(cls, documents, db=None):
+        """Return this instances converted from dicts in documents.
+
+        db is recorded on the instances so that deferred fields and
+        GridFS files are fetched from the database they were found in.
+        """
+        for obj in super().generateInstances(documents):
+            if db is not None:
+                obj.__dict__['_source_db'] = db
+            yield obj
+
+    def __sourceDb(self, db=None):
+        """Return db if given, otherwise the database this instance was found in."""
+        return db if db else self.__dict__.get('_source_db', self.__db)
+
+    def loadFields(self, keys=None, db=None):
+        """Fetch deferred fields not fetched yet in one query.
+
+        args:
+            keys (list): keys to fetch. all deferred fields if None.
+
+        returns:
+            self (MongoBase)
+        """
+        __db = self.__sourceDb(db)
+        keys = keys if keys else list(self.__lazy_fields__)
+        keys = [key for key in keys if self._rawValue(key) is DEFERRED]
+        if keys:
+            document = self._collection(__db).find_one(
+                {'_id': self._rawValue('_id')}, {key: 1 for key in keys})
+            if not document:
+                logging.warning('{} {} is not found in {} to load {}'.format(
+                    type(self).__name__, self._rawValue('_id'), __db.name, keys))
+            for key in keys:
+                dict.__setitem__(self, key, document.get(key) if document else None)
+        return self
+
+    def openGridFS(self, key, db=None):
+        """Open the GridFS file of a GridFSField and return a file-like GridOut.
+
+        The content is read by chunks.
+        """
+        __db = self.__sourceDb(db)
+        field = self.__lazy_fields__[key]
+        reference = self._rawValue(key)
+        return GridFSBucket(__db, field.bucket_name).open_download_stream(reference['gridfs_id'])
+
+    @classmethod
+    def __encodeLazyFields(cls, fields: dict, db=None):
+        """Encode values of LazyField in fields to the stored format.
+
+        Values of GridFSField are uploaded to GridFS and replaced with the reference.
+        """
+        for key, field in cls.__lazy_fields__.items():
+            if key not in fields or fields[key] is None or fields[key] is DEFERRED:
+                continue
+            if isinstance(field, GridFSField):
+                if not field.isEncoded(fields[key]):
+                    __db = db if db else cls.__db
+                    fields[key] = field.upload(
+                        GridFSBucket(__db, field.bucket_name), key, fields[key])
+            else:
+                fields[key] = field.encode(fields[key])
+        return fields
+
+    @classmethod
+    def __gridFSKeys(cls, keys=None):
+        """Return keys of GridFSField. only keys in keys if given."""
+        return [key for key, field in cls.__lazy_fields__.items()
+                if isinstance(field, GridFSField) and (keys is None or key in keys)]
+
+    @classmethod
+    def __gridFSFiles(cls, documents, keys):
+        """Return [(key, file_id),..] referenced by keys of documents."""
+        return [(key, document[key]['gridfs_id']) for document in documents for key in keys
+                if cls.__lazy_fields__[key].isEncoded(document.get(key))]
+
+    @classmethod
+    def __deleteGridFSFiles(cls, files, db=None):
+        """Delete GridFS files no longer referenced."""
+        __db = db if db else cls.__db
+        for key, file_id in files:
+            try:
+                GridFSBucket(__db, cls.__lazy_fields__[key].bucket_name).delete(file_id)
+            except NoFile:
+                pass
+
+    @classmethod
+    def findInRanges(cls, ranges_dict: dict, limit=None, skip=None, sort=None, query=None,
+                     hint=None, split_key=None, n_splits=1, max_workers=None, db=None, **kwargs) -> list:
+        """Find instances whose values are in ranges and return them.
+
+        Each range is low <= value < high. low or high can be None for no limit.
+        If n_splits > 1, the range of split_key is split into n_splits sub-ranges
+        which are queried in parallel threads and merged by sort.
+
+        args:
+            ranges_dict (dict): pairs like key: (low, high).
+                keys must be int, float or datetime fields in __structure__.
+            query (dict): conditions other than ranges. (optional)
+            hint (str or list): index name or keys to use. (optional)
+            split_key (str): the key to split. the first key of ranges_dict if None.
+            n_splits (int): # of sub-ranges queried in parallel.
+            max_workers (int): # of threads. n_splits if None.
+
+        returns:
+            objects (list): ModelBase instances.
+        """
+        range_query = dict(query) if query else {}
+        for key, (low, high) in ranges_dict.items():
+            cls.__validateRange(key, low, high)
+            condition = {}
+            if low is not None:
+                condition['$gte'] = low
+            if high is not None:
+                condition['$lt'] = high
+            # no condition for (None, None)
+            if condition:
+                range_query[key] = condition
+
+        split_key = split_key if split_key else next(iter(ranges_dict))
+        low, high = ranges_dict[split_key]
+        if n_splits <= 1 or low is None or high is None:
+            return cls.__findWithHint(
+                range_query, limit=limit, skip=skip, sort=sort, hint=hint, db=db, **kwargs)
+
+        # each sub-range returns up to skip + limit results which are merged
+        sub_limit = (skip or 0) + limit if limit else None
+        sub_queries = []
+        for sub_low, sub_high in cls.__splitRange(low, high, n_splits):
+            sub_query = dict(range_query)
+            sub_query[split_key] = dict(range_query[split_key], **{'$gte': sub_low, '$lt': sub_high})
+            sub_queries.append(sub_query)
+        if not sub_queries:
+            # empty range (low >= high)
+            return []
+        with ThreadPoolExecutor(max_workers=max_workers or len(sub_queries)) as executor:
+            results = list(executor.map(
+                lambda sub_query: cls.__findWithHint(
+                    sub_query, limit=sub_limit, sort=sort, hint=hint, db=db, **kwargs),
+                sub_queries))
+
+        sort = [(sort, ASCENDING)] if isinstance(sort, str) else sort
+        if not sort:
+            merged = [obj for objects in results for obj in objects]
+        elif sort[0][0] == split_key:
+            # sub-ranges are already in order of the first sort key
+            ordered = results if sort[0][1] == ASCENDING else reversed(results)
+            merged = [obj for objects in ordered for obj in objects]
+        else:
+            merged = list(heapq.merge(
+                *results, key=functools.cmp_to_key(lambda a, b: cls.__compareBySort(a, b, sort))))
+        start = skip or 0
+        return merged[start:start + limit] if limit else merged[start:]
+
+    @classmethod
+    def __findWithHint(cls, query, limit=None, skip=None, sort=None, hint=None, db=None, **kwargs):
+        cursor = cls.__find(query, limit=limit, skip=skip, sort=sort, db=db, **kwargs)
+        # aggregation of buckets can't be hinted
+        if hint and not cls.__bucket__:
+            cursor = cursor.hint(hint)
+        return list(cls.generateInstances(cursor, db=db))
+
+    @classmethod
+    def __validateRange(cls, key, low, high):
+        """Check the type of a range with __structure__."""
+        value_type = cls.__structure__.get(key)
+        if value_type not in (int, float, datetime.datetime):
+            raise TypeError(
+                'the key \'{}\' must be of type int, float or datetime for ranges but {}'
+                .format(key, value_type))
+        allowed = (int, float) if value_type in (int, float) else value_type
+        for value in (low, high):
+            if value is not None and not isinstance(value, allowed):
+                raise TypeError(
+                    'the range of the key \'{}\' must be of type {} but {}'
+                    .format(key, value_type, type(value)))
+
+    @staticmethod
+    def __splitRange(low, high, n_splits):
+        """Split [low, high) into n_splits sub-ranges.
+
+        returns:
+            sub-ranges (list): [(low, high),..] in ascending order.
+        """
+        if isinstance(low, int) and isinstance(high, int):
+            step = max(1, -(-(high - low) // n_splits))
+        else:
+            step = (high - low) / n_splits
+        bounds = []
+        sub_low = low
+        while sub_low < high and len(bounds) < n_splits:
+            sub_high = high if len(bounds) == n_splits - 1 else min(sub_low + step, high)
+            bounds.append((sub_low, sub_high))
+            sub_low = sub_high
+        return bounds
+
+    @staticmethod
+    def __compareBySort(a, b, sort):
+        """Compare two instances like MongoDB sort. None is the smallest."""
+        for key, direction in sort:
+            x, y = a.get(key), b.get(key)
+            if x == y:
+                continue
+            if x is None:
+                result = -1
+            elif y is None:
+                result = 1
+            else:
+                result = -1 if x < y else 1
+            return result if direction == ASCENDING else -result
+        return 0
+
+    @classmethod
+    def findColumns(cls, query: dict, fields: list, limit=None, skip=None, sort=None,
+                    batch_size=10000, as_numpy=False, db=None) -> dict:
+        """Find and return values of fields as columns.
+
+        No instance is created for each document.
+        int and float fields in __structure__ are stored in array.array.
+
+        args:
+            fields (list): keys to be returned.
+            batch_size (int): # of documents fetched in each batch.
+            as_numpy (bool): return numpy arrays if True. (numpy is required)
+
+        returns:
+            columns (dict): {field: array.array or list (or numpy.ndarray),..}
+        """
+        for columns in cls.iterColumns(
+                query, fields, chunk_size=None, limit=limit, skip=skip, sort=sort,
+                batch_size=batch_size, as_numpy=as_numpy, db=db):
+            return columns
+
+    @classmethod
+    def iterColumns(cls, query: dict, fields: list, chunk_size=10000, limit=None,
+                    skip=None, sort=None, batch_size=10000, as_numpy=False, db=None):
+        """Find and yield values of fields as columns chunk by chunk.
+
+        Memory usage is bounded by chunk_size.
+
+        args:
+            fields (list): keys to be returned.
+            chunk_size (int): max # of rows in each chunk. all rows in one chunk if None.
+            batch_size (int): # of documents fetched in each batch.
+            as_numpy (bool): yield numpy arrays if True. (numpy is required)
+
+        yields:
+            columns (dict): {field: array.array or list (or numpy.ndarray),..}
+        """
+        __db = db if db else cls.__db
+        assert not cls.__bucket__, 'columns can not be read from buckets'
+        cls.__recordQuery('findColumns', query, sort)
+        projection = {field: 1 for field in fields}
+        if '_id' not in projection:
+            projection['_id'] = 0
+        cursor = cls._collection(__db).find(query, projection).batch_size(batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        convert = to_numpy if as_numpy else lambda columns: columns
+        buffers = ColumnBuffers(cls.__structure__, fields)
+        for document in cursor:
+            buffers.append(document)
+            if chunk_size and len(buffers) >= chunk_size:
+                yield convert(buffers.columns)
+                buffers = ColumnBuffers(cls.__structure__, fields)
+        if len(buffers) or not chunk_size:
+            yield convert(buffers.columns)
 
     @classmethod
     def __find(cls, query, limit=None, skip=None, sort=None, db=None, **kwargs) \
@@ -228,52 +748,147 @@ class MongoBase(ModelBase):
             cursor objects (list): list of Pymongo cursor instances if found else None
         """
         __db = db if db else cls.__db
+        cls.__recordQuery('find', query, sort)
+        if cls.__bucket__:
+            assert not set(kwargs) - {'batch_size'}, f'{list(kwargs)} can not be used with buckets.'
+            return cls.__findInBuckets(
+                query, limit=limit, skip=skip, sort=sort, db=__db, batch_size=kwargs.get('batch_size'))
+        if 'projection' not in kwargs and cls.__deferredProjection():
+            kwargs['projection'] = cls.__deferredProjection()
+        collection = cls._collection(__db, as_instance=True)
         # limit & skip & sort
         if limit and skip and sort:
-            results = __db[cls.__collection__]\
-                .find(query, **kwargs).sort(sort).skip(skip).limit(limit)
+            results = collection.find(query, **kwargs).sort(sort).skip(skip).limit(limit)
 
         # limit & skip
         elif limit and skip and not sort:
-            results = __db[cls.__collection__]\
-                .find(query, **kwargs).skip(skip).limit(limit)
+            results = collection.find(query, **kwargs).skip(skip).limit(limit)
         # limit & sort
         elif limit and not skip and sort:
-            results = __db[cls.__collection__]\
-                .find(query, **kwargs).sort(sort).limit(limit)
+            results = collection.find(query, **kwargs).sort(sort).limit(limit)
         # skip & sort
         elif not limit and skip and sort:
-            results = __db[cls.__collection__]\
-                .find(query, **kwargs).sort(sort).skip(skip)
+            results = collection.find(query, **kwargs).sort(sort).skip(skip)
 
         # limit
         elif limit and not skip and not sort:
-            results = __db[cls.__collection__].find(
+            results = collection.find(
                 query, **kwargs).limit(limit)
         # skip
         elif not limit and skip and not sort:
-            results = __db[cls.__collection__].find(
+            results = collection.find(
                 query, **kwargs).skip(skip)
         # sort
         elif not limit and not skip and sort:
-            results = __db[cls.__collection__].find(
+            results = collection.find(
                 query, **kwargs).sort(sort)
 
         # (just find)
         else:
-            results = __db[cls.__collection__].find(query, **kwargs)
+            results = collection.find(query, **kwargs)
         return results
 
     @classmethod
-    def createIndexes(cls, db=None, **kwargs):
+    def __recordQuery(cls, operation, query, sort=None):
+        """Record the query shape if __query_recorder__ is set."""
+        if cls.__query_recorder__ is not None:
+            cls.__query_recorder__.record(
+                cls.__collection__, operation, query, sort)
+
+    @classmethod
+    def createIndexes(cls, db=None, indexes=None, **kwargs):
         """ Create indexes defined in __indexes__
+
+        Each index is either keys ('key' or [('key', ASCENDING),..])
+        or a dict of keys and options like
+        {'keys': [('created', ASCENDING)], 'expireAfterSeconds': 86400}.
+        expireAfterSeconds of an existing TTL index is changed by collMod.
+
+        args:
+            indexes (list): indexes to create instead of __indexes__. (optional)
         """
         __db = db if db else cls.__db
-        if len(cls.__indexes__) >= 1:
-            for index in cls.__indexes__:
+        indexes = cls.__indexes__ if indexes is None else indexes
+        if len(indexes) >= 1:
+            for index in indexes:
+                keys, options = cls.__indexSpec(index)
+                options.update(kwargs)
                 logging.info('start creating index: {} {}'.format(cls.__name__, index))
-                __db[cls.__collection__].create_index(index, background=True, **kwargs)
+                try:
+                    cls._collection(__db).create_index(keys, background=True, **options)
+                except OperationFailure as e:
+                    # IndexOptionsConflict: the TTL index exists with other expireAfterSeconds
+                    if e.code != 85 or 'expireAfterSeconds' not in options:
+                        raise
+                    __db.command('collMod', cls.__collection__, index={
+                        'keyPattern': dict(keys),
+                        'expireAfterSeconds': options['expireAfterSeconds']})
                 logging.info('finished creating index: {} {}'.format(cls.__name__, index))
+        if cls.__bucket__:
+            # for upserts and time range reads of buckets
+            cls._collection(__db).create_index(
+                [('meta', ASCENDING), ('start', ASCENDING)], background=True)
+
+    @classmethod
+    def __indexSpec(cls, index):
+        """Return keys and options of an index in __indexes__.
+
+        TTL index must be a single key of a datetime field in __structure__.
+        """
+        if not isinstance(index, dict):
+            return index, {}
+        options = dict(index)
+        keys = options.pop('keys')
+        if 'expireAfterSeconds' in options:
+            keys = [(keys, ASCENDING)] if isinstance(keys, str) else keys
+            assert len(keys) == 1 and cls.__structure__.get(keys[0][0]) is datetime.datetime, \
+                f'TTL index must be a single datetime field but {keys}'
+        return keys, options
+
+    @classmethod
+    def adviseIndexes(cls, top=10, create=False, db=None):
+        """Suggest indexes from the query shapes recorded by __query_recorder__.
+
+        Runs explain() on the most frequent shapes of this collection
+        and flags collection scans and in-memory sorts.
+        Text search shapes are skipped as they use the search_text index.
+
+        args:
+            top (int): # of the most frequent shapes to examine.
+            create (bool): create suggested indexes with createIndexes() if True.
+
+        returns:
+            advices (list): [{'shape': dict, 'collection_scan': bool,
+                              'in_memory_sort': bool, 'index': list or None},..]
+        """
+        assert cls.__query_recorder__ is not None, \
+            '__query_recorder__ must be set to advise indexes'
+        __db = db if db else cls.__db
+        advices = []
+        suggestions = []
+        for shape in cls.__query_recorder__.top(top, collection=cls.__collection__):
+            if shape['operation'] == 'textSearch':
+                continue
+            cursor = cls._collection(__db).find(shape['sample_query'])
+            if shape['sample_sort']:
+                cursor = cursor.sort(shape['sample_sort'])
+            collection_scan, in_memory_sort = plan_issues(cursor.explain())
+            index = None
+            if collection_scan or in_memory_sort:
+                index = suggest_index(shape['query_shape'], shape['sort_shape'])
+                if not index or is_covered(index, cls.__indexes__ + suggestions):
+                    index = None
+                else:
+                    suggestions.append(index)
+            advices.append({
+                'shape': shape,
+                'collection_scan': collection_scan,
+                'in_memory_sort': in_memory_sort,
+                'index': index,
+            })
+        if create and suggestions:
+            cls.createIndexes(indexes=suggestions, db=__db)
+        return advices
 
     def insertIfNotExistsWithKeys(self, *args, db=None):
         """Insert this object to db if not already exists.
@@ -281,6 +896,7 @@ class MongoBase(ModelBase):
         returns:
             insertion results (MongoBase object or None): if already inserted, returns None.
         """
+        MongoBase.__rejectBuckets(self, 'insertIfNotExistsWithKeys')
         query = {key: getattr(self, key) for key in args}
         return self.insertIfNotExistsWithQueryDict(query, db=db)
 
@@ -293,8 +909,9 @@ class MongoBase(ModelBase):
         returns:
             result (MongoBase object or None): returns self if inserted
         """
+        MongoBase.__rejectBuckets(self, 'insertIfNotExistsWithQueryDict')
         __db = db if db else self.__db
-        if bool(query) and __db[self.__collection__].find_one(query):
+        if bool(query) and self._collection(__db).find_one(query):
             logging.info('ALREADY EXISTS, NOT SAVE')
             return None
         else:
@@ -310,19 +927,18 @@ class MongoBase(ModelBase):
             4. calls create_index() method in pymongo if __search_text_keys__ has any value.
         """
         __db = db if db else self.__db
-        storeable_document = self.__prepare_insert()
-        if __db[self.__collection__].insert_one(storeable_document):
+        storeable_document = self.__prepare_insert(db=__db)
+        if self._collection(__db).insert_one(storeable_document):
             # create search index after inserted
             if self.__search_text_keys__:
-                __db[self.__collection__].create_index(
-                    [('search_text', TEXT)], default_language='english')
+                self.__createSearchIndex(__db)
             logging.info(u'NEW {} INSERTED.'.format(self))
             return self
         else:
             logging.info(u'[WARNING] {} NOT INSERTED.'.format(self))
             return None
 
-    def __prepare_insert(self):
+    def __prepare_insert(self, db=None):
         """Convert to a storeable formatted document.
 
         return:
@@ -332,10 +948,26 @@ class MongoBase(ModelBase):
         assert self._is_required_fields_satisfied()
         # prepare document to save
         document = self.purify()
+        # 'updated' is the time of the last write including the insert if not given
+        # (incremental refreshes of __materialized__ models depend on it)
+        if 'updated' in self.__structure__ and document.get('updated') is None:
+            document['updated'] = datetime.datetime.now(datetime.timezone.utc)
+            dict.__setitem__(self, 'updated', document['updated'])
+        if self.__lazy_fields__:
+            self.__encodeLazyFields(document, db=db)
+            # keep GridFS references not to upload again
+            for key, field in self.__lazy_fields__.items():
+                if isinstance(field, GridFSField) and key in document:
+                    dict.__setitem__(self, key, document[key])
         assert '_id' in document, \
             f'document must have key "_id". but not in {document}.'
+        # set search_tokens
+        if self.__search_text_keys__ and self.__search_text_index_mode__ == 'tokens':
+            search_tokens = self.generateSearchTokens(self)
+            document.update({'search_tokens': search_tokens})
+            self.search_tokens = search_tokens
         # set search_text
-        if self.__search_text_keys__:
+        elif self.__search_text_keys__:
             # select index method
             if self.__search_text_weight_type__ == 'uniform':
                 search_text = ' '.join(
@@ -382,14 +1014,16 @@ class MongoBase(ModelBase):
             inserted_count (int): # of documents inserted.
         """
         __db = db if db else cls.__db
+        if cls.__bucket__:
+            return cls.__insertIntoBuckets(inserts, db=__db)
         requests = []
         for obj in inserts:
             assert isinstance(obj, cls),\
                 f'all objects must be MongoBase objects. but {obj} is {type(obj)}.'
             # create a valid document to insert
-            storeable_document = obj.__prepare_insert()
+            storeable_document = obj.__prepare_insert(db=__db)
             requests += [InsertOne(storeable_document)]
-        result = __db[cls.__collection__].bulk_write(requests)
+        result = cls._collection(__db).bulk_write(requests)
         return result.inserted_count
 
     @classmethod
@@ -398,30 +1032,144 @@ class MongoBase(ModelBase):
 
         args:
             updates (list): list of update dictionaries.
+                each can be fields to $set, update operators or a pipeline.
             ids (list): list of _id of documents to be updated. (optional)
 
         *if updates have _id, ids is not required
+        (ids are required for update operators and pipelines)
 
         returns:
             updated_count (int): # of documents updated.
         """
+        MongoBase.__rejectBuckets(cls, 'bulk_update')
         __db = db if db else cls.__db
         requests = []
         if ids:
             for _id, update in zip(ids, updates):
-                update = cls.__prepare_updates(update)
-                requests += [UpdateOne({'_id': _id}, update)]
+                requests += [UpdateOne({'_id': _id}, cls.__prepare_updates(update, db=__db))]
         else:
             for update in updates:
+                if not isinstance(update, dict) or any(key.startswith('$') for key in update):
+                    raise Exception('ids are required for update operators and pipelines.')
                 assert update.get('_id'),\
                     '_id is required in update object when ids are not set in the argument.'
                 _id = update.get('_id')
-                update = cls.__prepare_updates(update)
-                requests += [UpdateOne({'_id': _id}, {'$set': update})]
-        print(requests[0])
-        result = __db[cls.__collection__].bulk_write(requests)
+                requests += [UpdateOne({'_id': _id}, cls.__prepare_updates(update, db=__db))]
+        result = cls._collection(__db).bulk_write(requests)
         return result.modified_count
 
+    @classmethod
+    def __bucketSpec(cls):
+        """Return __bucket__ with default values."""
+        spec = dict({'meta_key': None, 'max_count': 1000}, **cls.__bucket__)
+        assert cls.__structure__.get(spec['time_key']) is datetime.datetime, \
+            f'time_key must be a datetime key in __structure__ but {spec["time_key"]}'
+        return spec
+
+    @staticmethod
+    def __bucketStart(time, granularity):
+        """Return the start of the time window containing time."""
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=time.tzinfo)
+        return epoch + ((time - epoch) // granularity) * granularity
+
+    @classmethod
+    def __insertIntoBuckets(cls, inserts: list, db=None):
+        """Append instances to the buckets of their entity and time window.
+
+        Each bucket is like {'meta': entity, 'start': window start,
+        'min_time': .., 'max_time': .., 'count': n, 'measurements': [document,..]}.
+        One upsert with $push and $inc is sent for each bucket.
+
+        returns:
+            inserted_count (int): # of instances inserted.
+        """
+        __db = db if db else cls.__db
+        spec = cls.__bucketSpec()
+        time_key, meta_key = spec['time_key'], spec['meta_key']
+        groups = {}
+        for obj in inserts:
+            assert isinstance(obj, cls),\
+                f'all objects must be MongoBase objects. but {obj} is {type(obj)}.'
+            document = obj.__prepare_insert(db=__db)
+            assert document[time_key] is not None, f'{time_key} is required for buckets.'
+            meta = document.pop(meta_key) if meta_key else None
+            start = cls.__bucketStart(document[time_key], spec['granularity'])
+            groups.setdefault((repr(meta), start), (meta, start, []))[2].append(document)
+        requests = []
+        for meta, start, documents in groups.values():
+            for i in range(0, len(documents), spec['max_count']):
+                chunk = documents[i:i + spec['max_count']]
+                times = [document[time_key] for document in chunk]
+                requests += [UpdateOne(
+                    {'meta': meta, 'start': start,
+                     'count': {'$lte': spec['max_count'] - len(chunk)}},
+                    {'$push': {'measurements': {'$each': chunk}},
+                     '$inc': {'count': len(chunk)},
+                     '$min': {'min_time': min(times)},
+                     '$max': {'max_time': max(times)}},
+                    upsert=True)]
+        if requests:
+            cls._collection(__db).bulk_write(requests, ordered=False)
+        return len(inserts)
+
+    @classmethod
+    def __findInBuckets(cls, query, limit=None, skip=None, sort=None, db=None, batch_size=None):
+        """Find instances in buckets and return a cursor of them."""
+        pipeline = cls.__bucketPipeline(query)
+        if sort:
+            pipeline.append({'$sort': dict([(sort, ASCENDING)] if isinstance(sort, str) else sort)})
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        # $sort of unwound instances can exceed the memory limit of 100MB
+        return cls._collection(db, as_instance=True).aggregate(
+            pipeline, batchSize=batch_size, allowDiskUse=True)
+
+    @classmethod
+    def __bucketPipeline(cls, query):
+        """Return the pipeline unwinding buckets to documents matched with query.
+
+        Buckets are prefiltered by the entity and the time range in query,
+        then unwound to instances and filtered by query.
+        """
+        spec = cls.__bucketSpec()
+        time_key, meta_key = spec['time_key'], spec['meta_key']
+        bucket_query = {}
+        if meta_key and meta_key in query:
+            bucket_query['meta'] = query[meta_key]
+        condition = query.get(time_key)
+        if isinstance(condition, dict):
+            for operator, value in condition.items():
+                if operator in ('$gte', '$gt'):
+                    bucket_query['max_time'] = {operator: value}
+                    bucket_query.setdefault('start', {})['$gt'] = value - spec['granularity']
+                elif operator in ('$lt', '$lte'):
+                    bucket_query['min_time'] = {operator: value}
+                    bucket_query.setdefault('start', {})[operator] = value
+        elif isinstance(condition, datetime.datetime):
+            bucket_query['min_time'] = {'$lte': condition}
+            bucket_query['max_time'] = {'$gte': condition}
+
+        pipeline = [{'$match': bucket_query}, {'$unwind': '$measurements'}]
+        if meta_key:
+            pipeline.append({'$replaceRoot': {'newRoot': {
+                '$mergeObjects': ['$measurements', {meta_key: '$meta'}]}}})
+        else:
+            pipeline.append({'$replaceRoot': {'newRoot': '$measurements'}})
+        if query:
+            pipeline.append({'$match': query})
+        return pipeline
+
+    @staticmethod
+    def __rejectBuckets(cls_or_instance, operation):
+        """Raise Exception for writes by _id which can not address documents in buckets."""
+        if cls_or_instance.__bucket__:
+            raise Exception(
+                '{}() can not be used with buckets. (__bucket__ of {} is set)'
+                .format(operation, cls_or_instance.__name__
+                        if inspect.isclass(cls_or_instance) else type(cls_or_instance).__name__))
+
     def updateWithCorrespondentKey(self, find_key, db=None):
         """Update an instance with the identical key.
 
@@ -429,7 +1177,7 @@ class MongoBase(ModelBase):
             find_key (str): the key of instance to identify the document.
         """
         if hasattr(self, find_key) and getattr(self, find_key):
-            storeable_document = self.__prepare_insert()
+            storeable_document = self.__prepare_insert(db=db)
             return MongoBase.__findAndUpdate(
                 self, find_key, getattr(self, find_key), storeable_document, db=db)
         return None
@@ -440,7 +1188,8 @@ class MongoBase(ModelBase):
 
         args:
             _id (any type): any type of value defined in the __structure__
-            update (dict): key,value pairs to update.
+            update (dict or list): key,value pairs to update,
+                update operators like {'$inc': {'count': 1}} or an aggregation pipeline.
 
         __findAndUpdate() is called finally.
         """
@@ -456,19 +1205,28 @@ class MongoBase(ModelBase):
             cls_or_instance (MongoBase subclass or instance):
             find_key (any type): identical key to find a document to update
             find_val (any type): identical value to find a document to update
-            update (dict): keys and values to be updated.
+            update (dict or list): keys and values, update operators or a pipeline.
         """
+        MongoBase.__rejectBuckets(cls_or_instance, 'update')
         __db = db if db else cls_or_instance.__db
+        # GridFS files replaced by the update are deleted after the update
+        gridfs_keys = cls_or_instance.__gridFSKeys(MongoBase.__updatedKeys(update))
+        replaced = []
+        if gridfs_keys:
+            before = cls_or_instance._collection(__db).find_one(
+                {find_key: find_val}, {key: 1 for key in gridfs_keys})
+            replaced = cls_or_instance.__gridFSFiles([before] if before else [], gridfs_keys)
         # create a valid update object
-        update = cls_or_instance.__prepare_updates(update)
-        # update object must be like {'$set': {'key': val,...}}
-        # otherwise, the rest of fields will be removed
-        update_set = {'$set': update}
-        document = __db[cls_or_instance.__collection__] \
+        update_set = cls_or_instance.__prepare_updates(update, db=__db)
+        document = cls_or_instance._collection(__db) \
             .find_one_and_update(
                 {find_key: find_val},
                 update_set,
                 return_document=ReturnDocument.AFTER)
+        if replaced:
+            kept = set(cls_or_instance.__gridFSFiles([document] if document else [], gridfs_keys))
+            cls_or_instance.__deleteGridFSFiles(
+                [file for file in replaced if file not in kept], db=__db)
         if not document:
             return None
         if inspect.isclass(cls_or_instance):
@@ -477,17 +1235,223 @@ class MongoBase(ModelBase):
             return cls_or_instance
 
     @classmethod
-    def __prepare_updates(cls, update: dict):
+    def __prepare_updates(cls, update, db=None):
         """Create an valid update object.
 
+        Only fields affected by the update are validated.
+        'updated' and search_text (or search_tokens) are maintained in every form.
+
+        args:
+            update (dict or list): one of
+                - keys and values to be updated. ({'key': val,..})
+                - update operators. ({'$inc': {'key': 1}, '$push': {'key': val},..})
+                - an aggregation pipeline. ([{'$set': {..}},..])
+
+        returns:
+            update (dict or list): update document or pipeline for pymongo.
+        """
+        if isinstance(update, list):
+            return cls.__preparePipelineUpdates(update)
+        if update and all(key.startswith('$') for key in update):
+            return cls.__replaceSearchTokens(cls.__prepareOperatorUpdates(update, db=db))
+        if any(key.startswith('$') for key in update):
+            raise Exception('update must be either fields or update operators')
+        # update object must be like {'$set': {'key': val,...}}
+        # otherwise, the rest of fields will be removed
+        return cls.__replaceSearchTokens({'$set': cls.__prepareFieldUpdates(update, db=db)})
+
+    @classmethod
+    def __replaceSearchTokens(cls, update: dict):
+        """Replace search_tokens of the search keys changed by $set or $unset.
+
+        search_tokens is set as it is if all search keys are changed,
+        otherwise the update is converted to a pipeline which keeps tokens
+        of the other keys in the document. (MongoDB 4.2+)
+
+        args:
+            update (dict): update operators.
+
+        returns:
+            update (dict or list): update document or pipeline for pymongo.
+        """
+        if not cls.__search_text_keys__ or cls.__search_text_index_mode__ != 'tokens':
+            return update
+        search_keys = cls.__searchKeys()
+        fields = dict(update.get('$set', {}))
+        fields.update({key: None for key in search_keys.intersection(update.get('$unset', {}))})
+        changed = search_keys.intersection(fields)
+        if not changed:
+            return update
+        if changed == search_keys:
+            update.setdefault('$set', {})['search_tokens'] = cls.generateSearchTokens(fields)
+            return update
+        if set(update) - {'$set', '$unset'}:
+            raise Exception(
+                'search tokens can not be updated with {}. update {} separately'
+                .format(sorted(set(update) - {'$set', '$unset'}), sorted(changed)))
+        stage = {key: {'$literal': value} for key, value in update.get('$set', {}).items()}
+        stage['search_tokens'] = cls.__searchTokensExpression(fields)
+        pipeline = [{'$set': stage}]
+        if '$unset' in update:
+            pipeline.append({'$unset': list(update['$unset'])})
+        return pipeline
+
+    @classmethod
+    def __searchTokensExpression(cls, fields: dict):
+        """Return an expression of search_tokens with tokens of the search keys in fields replaced."""
+        keys = sorted(cls.__searchKeys().intersection(fields))
+        return {'$concatArrays': [
+            {'$filter': {
+                'input': {'$ifNull': ['$search_tokens', []]},
+                'as': 'token',
+                'cond': {'$not': [{'$in': ['$$token.k', keys]}]}}},
+            {'$literal': cls.generateSearchTokens(fields)}]}
+
+    @classmethod
+    def __prepareOperatorUpdates(cls, update: dict, db=None):
+        """Validate fields affected by update operators.
+
+        $set, $setOnInsert, $min, $max: values are validated like fields.
+        $inc, $mul: values and declared types must be numbers.
+        $push, $addToSet, $pull, $pullAll, $pop: declared types must be list.
+        $unset: required fields can not be unset.
+        """
+        update = {operator: dict(fields) for operator, fields in update.items()}
+        for operator, fields in update.items():
+            # only top level keys in __structure__ are validated
+            keys = [key for key in fields if key in cls.__structure__]
+            if operator in ('$set', '$setOnInsert', '$min', '$max'):
+                cls({}).validate(fields, keys=keys)
+            elif operator in ('$inc', '$mul'):
+                for key, value in fields.items():
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        raise TypeError(
+                            'the value of {} for the key \'{}\' must be a number but {}'
+                            .format(operator, key, type(value)))
+                for key in keys:
+                    if cls.__structure__[key] not in (int, float):
+                        raise TypeError(
+                            'the key \'{}\' must be of type int or float for {} but {}'
+                            .format(key, operator, cls.__structure__[key]))
+            elif operator in ('$push', '$addToSet', '$pull', '$pullAll', '$pop'):
+                for key in keys:
+                    if cls.__structure__[key] is not list:
+                        raise TypeError(
+                            'the key \'{}\' must be of type list for {} but {}'
+                            .format(key, operator, cls.__structure__[key]))
+            elif operator == '$unset':
+                for key in keys:
+                    if key in cls.__required_fields__:
+                        raise RequiredKeyIsNotSatisfied(
+                            'the key \'{}\' must not be unset'.format(key))
+        if '_id' in update.get('$set', {}):
+            del update['$set']['_id']
+        # update search_text if the related field is set
+        if '$set' in update:
+            cls.__prepareSearchUpdates(update['$set'])
+            cls.__encodeLazyFields(update['$set'], db=db)
+        if not any('updated' in fields for fields in update.values()):
+            update.setdefault('$set', {})['updated'] = datetime.datetime.now(datetime.timezone.utc)
+        return update
+
+    @classmethod
+    def __preparePipelineUpdates(cls, pipeline: list):
+        """Validate literal values set in an update pipeline.
+
+        Values given as aggregation expressions can not be validated.
+        search_text (or search_tokens) is updated only when the related fields
+        are set to literal values, otherwise Exception is raised.
+        """
+        search_keys = cls.__searchKeys()
+        search_fields = {}
+        sets_updated = False
+        for stage in pipeline:
+            fields = stage.get('$set', stage.get('$addFields', {}))
+            literals = {key: value for key, value in fields.items()
+                        if not cls.__isExpression(value)}
+            keys = [key for key in literals if key in cls.__structure__]
+            cls({}).validate(literals, keys=keys)
+            sets_updated = sets_updated or 'updated' in fields
+            for key in search_keys.intersection(fields):
+                if key not in literals:
+                    raise Exception(
+                        'search text can not be updated from the expression for \'{}\''
+                        .format(key))
+                search_fields[key] = literals[key]
+        stage = {} if sets_updated else {'updated': datetime.datetime.now(datetime.timezone.utc)}
+        if search_fields and cls.__search_text_index_mode__ == 'tokens':
+            stage['search_tokens'] = cls.__searchTokensExpression(search_fields)
+        elif search_fields:
+            cls.__prepareSearchUpdates(search_fields)
+            if 'search_text' in search_fields:
+                stage['search_text'] = {'$literal': search_fields['search_text']}
+        return list(pipeline) + [{'$set': stage}] if stage else list(pipeline)
+
+    @staticmethod
+    def __updatedKeys(update):
+        """Return top level keys set or unset by fields, update operators or a pipeline."""
+        if isinstance(update, list):
+            stages = [stage.get('$set', stage.get('$addFields', {})) for stage in update]
+            return {key for fields in stages for key in fields}
+        if update and all(key.startswith('$') for key in update):
+            return {key.split('.')[0] for operator in ('$set', '$unset')
+                    for key in update.get(operator, {})}
+        return set(update)
+
+    @staticmethod
+    def __isExpression(value):
+        """Return True if value is an aggregation expression."""
+        if isinstance(value, str):
+            return value.startswith('$')
+        if isinstance(value, dict):
+            return any(str(key).startswith('$') for key in value)
+        if isinstance(value, list):
+            return any(MongoBase.__isExpression(item) for item in value)
+        return False
+
+    @classmethod
+    def __searchKeys(cls):
+        """Return keys of __search_text_keys__ as a set."""
+        if not cls.__search_text_keys__:
+            return set()
+        return {key for key, _ in cls.__searchKeysAndWeights()}
+
+    @classmethod
+    def __prepareFieldUpdates(cls, update: dict, db=None):
+        """Create an valid update fields to $set.
+
         args:
             update (dict): keys and values to be updated.
         """
         update['updated'] = datetime.datetime.now(datetime.timezone.utc)
+        cls.__prepareSearchUpdates(update)
+        cls.__encodeLazyFields(update, db=db)
+        # validate
+        assert cls({}).validate(update, keys=[key for key in update if key in cls.__structure__])
+        # return update dict excluding key '_id'
+        return {k:v for k,v in update.items() if k != '_id'}
+
+    @classmethod
+    def __prepareSearchUpdates(cls, update: dict):
+        """Set search_text to update if the related field changed.
+
+        search_tokens are replaced by __replaceSearchTokens() in tokens mode.
+        search_text is generated from all search keys, so all of them must be
+        in update if any of them is. (otherwise Exception is raised)
+
+        args:
+            update (dict): keys and values to be set.
+        """
+        if cls.__search_text_index_mode__ == 'tokens':
+            return update
+        search_keys = cls.__searchKeys()
         # update search_text if the related field changed
-        if cls.__search_text_keys__\
-                and list(set(update).intersection(
-                    cls.__search_text_keys__)):
+        if search_keys.intersection(update):
+            missing_keys = sorted(search_keys - set(update))
+            if missing_keys:
+                raise Exception(
+                    'search_text can not be updated without {}. set all of {} together'
+                    .format(missing_keys, sorted(search_keys)))
 
             # select index method
             if cls.__search_text_weight_type__ == 'uniform':
@@ -514,10 +1478,7 @@ class MongoBase(ModelBase):
             #     )
             else:
                 raise Exception('index unit must be either bigram or morpheme')
-        # validate
-        assert cls(update).validate()
-        # return update dict excluding key '_id'
-        return {k:v for k,v in update.items() if k != '_id'}
+        return update
 
     @classmethod
     def updateMany(
@@ -525,6 +1486,10 @@ class MongoBase(ModelBase):
             bypass_document_validation=False, collation=None, session=None, db=None):
         """Update specific fields for many documents.
 
+        args:
+            update (dict or list): key,value pairs to update,
+                update operators like {'$inc': {'count': 1}} or an aggregation pipeline.
+
         returns:
             - matched_count: int
             - modified_count: int
@@ -543,10 +1508,13 @@ class MongoBase(ModelBase):
         """Update specific fields for many documents.
 
         equal to db.collection.updateMany(query, {$set: {key: new_val})
+        if update is fields, otherwise update operators or pipeline are passed as they are.
         """
+        MongoBase.__rejectBuckets(cls_or_instance, 'updateMany')
         __db = db if db else cls_or_instance.__db
-        return __db[cls_or_instance.__collection__].update_many(
-            query, {'$set': update}, upsert=upsert, array_filters=array_filters,
+        update = cls_or_instance.__prepare_updates(update, db=__db)
+        return cls_or_instance._collection(__db).update_many(
+            query, update, upsert=upsert, array_filters=array_filters,
             bypass_document_validation=bypass_document_validation,
             collation=collation, session=session)
 
@@ -558,6 +1526,95 @@ class MongoBase(ModelBase):
     def delete(cls, query, db=None):
         return cls.__delete(query, db=db)
 
+    @classmethod
+    def purge(cls, query, batch_size=1000, max_rate=None, progress=None, db=None):
+        """Delete matched documents chunk by chunk in _id order.
+
+        Unlike delete(), documents are deleted by batch_size with delete_many()
+        and throttled to max_rate, not to stress the primary and replication.
+        Deleting is resumed just by calling again with the same query
+        since deleted documents are no longer matched.
+        GridFS files of GridFSField are deleted with the documents.
+
+        args:
+            query (dict): documents to delete.
+            batch_size (int): # of documents deleted at once.
+            max_rate (float): max # of documents deleted per second. (optional)
+            progress (function): called as progress(deleted_count, last_id) after each chunk. (optional)
+
+        returns:
+            deleted_count (int): # of deleted documents
+        """
+        MongoBase.__rejectBuckets(cls, 'purge')
+        __db = db if db else cls.__db
+        collection = cls._collection(__db)
+        gridfs_keys = cls.__gridFSKeys()
+        limiter = RateLimiter(max_rate)
+        deleted_count = 0
+        last_id = None
+        while True:
+            chunk_query = query if last_id is None \
+                else {'$and': [query, {'_id': {'$gt': last_id}}]}
+            documents = list(collection.find(chunk_query, {key: 1 for key in ['_id'] + gridfs_keys})
+                             .sort('_id', ASCENDING).limit(batch_size))
+            ids = [document['_id'] for document in documents]
+            if not ids:
+                break
+            result = collection.delete_many({'$and': [query, {'_id': {'$in': ids}}]})
+            if gridfs_keys:
+                # documents changed not to match query meanwhile are not deleted
+                remaining = {document['_id'] for document in
+                             collection.find({'_id': {'$in': ids}}, {'_id': 1})}
+                cls.__deleteGridFSFiles(cls.__gridFSFiles(
+                    [document for document in documents if document['_id'] not in remaining],
+                    gridfs_keys), db=__db)
+            deleted_count += result.deleted_count
+            last_id = ids[-1]
+            logging.info('purged: {} {} (last _id: {})'.format(cls.__name__, deleted_count, last_id))
+            if progress:
+                progress(deleted_count, last_id)
+            limiter.wait(len(ids))
+        return deleted_count
+
+    @classmethod
+    def migrate(cls, name, transform, query=None, batch_size=1000, max_rate=None,
+                max_replication_lag=None, n_partitions=1, restart=False, db=None):
+        """Apply transform to existing documents by batches (online migration).
+
+        Documents are read in _id order and updated by bulk_write.
+        Updates are validated and 'updated', search_text (or search_tokens) are
+        maintained like findAndUpdateById().
+        Progress is saved in the collection 'mongobase_migrations' and
+        the migration is resumed by calling again with the same name.
+
+        e.g.) recompute search_text after __search_text_keys__ changed
+            Bird.migrate('search_text_v2', lambda bird: {key: bird[key] for key in keys})
+
+        args:
+            name (str): the name of the migration.
+            transform (function): transform(instance) returns fields to $set,
+                update operators or None to skip the instance.
+            query (dict): documents to migrate. (optional)
+            batch_size (int): # of documents read and written at once.
+            max_rate (float): max # of documents per second. (optional)
+            max_replication_lag (float): wait while secondaries are behind more than
+                these seconds. (optional)
+            n_partitions (int): # of _id partitions migrated concurrently.
+            restart (bool): discard the saved progress and start from the beginning.
+
+        returns:
+            count (int): # of documents processed.
+        """
+        MongoBase.__rejectBuckets(cls, 'migrate')
+        __db = db if db else cls.__db
+        runner = MigrationRunner(
+            cls._collection(__db, as_instance=True), name, transform,
+            prepare=functools.partial(cls.__prepare_updates, db=__db),
+            hydrate=cls.generateInstances, query=query, batch_size=batch_size,
+            max_rate=max_rate, max_replication_lag=max_replication_lag,
+            n_partitions=n_partitions)
+        return runner.run(restart=restart)
+
     @classmethod
     def __delete_one(cls, query, db=None):
         """Wrapper of delete_one()
@@ -565,8 +1622,15 @@ class MongoBase(ModelBase):
         returns:
             deleted_count (int): # of deleted documents
         """
+        MongoBase.__rejectBuckets(cls, 'delete')
         __db = db if db else cls.__db
-        result = __db[cls.__collection__].delete_one(query)
+        gridfs_keys = cls.__gridFSKeys()
+        if gridfs_keys:
+            document = cls._collection(__db).find_one_and_delete(
+                query, {key: 1 for key in gridfs_keys})
+            cls.__deleteGridFSFiles(cls.__gridFSFiles([document] if document else [], gridfs_keys), db=__db)
+            return 1 if document else 0
+        result = cls._collection(__db).delete_one(query)
         return result.deleted_count
 
     @classmethod
@@ -576,8 +1640,13 @@ class MongoBase(ModelBase):
         returns:
             deleted_count (int): # of deleted documents
         """
+        MongoBase.__rejectBuckets(cls, 'delete')
         __db = db if db else cls.__db
-        result = __db[cls.__collection__].delete_many(query)
+        gridfs_keys = cls.__gridFSKeys()
+        if gridfs_keys:
+            # delete matched documents by chunks to delete their GridFS files
+            return cls.purge(query, db=__db)
+        result = cls._collection(__db).delete_many(query)
         return result.deleted_count
 
     @staticmethod
@@ -632,7 +1701,7 @@ class MongoBase(ModelBase):
 
     @classmethod
     def textSearch(cls, text, limit, skip, query=None, sort=None, # with_kana=False, with_unigram=False,
-                   db=None, **kwargs):
+                   db=None, match='all', **kwargs):
         """Find by text search and return all matched instances.
 
         args:
@@ -641,12 +1710,18 @@ class MongoBase(ModelBase):
             skip (int):
             query(dict):
             sort (int): condition other than text search
+            match (str): 'all' or 'any' tokens must match. (only for 'tokens' mode)
         """
         __db = db if db else cls.__db
 
         if not query:
             query = {}
 
+        if cls.__search_text_index_mode__ == 'tokens':
+            assert not set(kwargs) - {'projection', 'batch_size'}, \
+                f'{list(kwargs)} can not be used with tokens mode.'
+            return cls.__tokenSearch(text, limit, skip, query, sort, match=match, db=__db, **kwargs)
+
         if cls.__search_text_index_unit__ == 'bigram':
             query['$text'] = {'$search': cls.generateSearchBiGramStr(text)}
         # NOTE: remove comment out when you use in the specific case for japanese
@@ -662,14 +1737,218 @@ class MongoBase(ModelBase):
         if not sort:
             # if no sort condition is set, the order follows textScore.
             sort = [('score', {'$meta': 'textScore'})]
+        cls.__recordQuery('textSearch', query, sort)
 
-        cursor = __db[cls.__collection__].find(
+        cursor = cls._collection(__db, as_instance=True).find(
             query,
             {'score': {'$meta': 'textScore'}},
             **kwargs).skip(skip).limit(limit)
         print(f'B : {cursor}')
         cursorResults = cursor.sort(sort)
-        return list(cls.generateInstances(cursorResults))
+        return list(cls.generateInstances(cursorResults, db=db))
+
+    @classmethod
+    def __tokenSearch(cls, text, limit, skip, query, sort=None, match='all', db=None,
+                      projection=None, batch_size=None):
+        """Find by search_tokens and return matched instances ranked on the server.
+
+        The multikey index on search_tokens.t prefilters documents with $all or $in,
+        then score is the sum of weights of matched tokens.
+        projection (dict or list) is applied after ranking.
+        """
+        tokens = sorted(set(cls.generateSearchBiGramStr(text).lower().split()))
+        if not tokens:
+            return []
+        if match == 'all':
+            query['search_tokens.t'] = {'$all': tokens}
+        elif match == 'any':
+            query['search_tokens.t'] = {'$in': tokens}
+        else:
+            raise Exception('match must be either all or any')
+        cls.__recordQuery('textSearch', query, sort)
+
+        pipeline = [
+            {'$match': query},
+            {'$addFields': {'score': {'$sum': {'$map': {
+                'input': {'$filter': {
+                    'input': '$search_tokens',
+                    'as': 'token',
+                    'cond': {'$in': ['$$token.t', tokens]}}},
+                'as': 'token',
+                'in': '$$token.w'}}}}},
+            # if no sort condition is set, the order follows score.
+            {'$sort': dict(sort) if sort else {'score': DESCENDING, '_id': ASCENDING}},
+        ]
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        projection = projection if projection else cls.__deferredProjection()
+        if projection:
+            pipeline.append({'$project': projection if isinstance(projection, dict)
+                             else {key: 1 for key in projection}})
+        results = cls._collection(db, as_instance=True).aggregate(pipeline, batchSize=batch_size)
+        return list(cls.generateInstances(results, db=db))
+
+    @classmethod
+    def __searchKeysAndWeights(cls):
+        """Return [(key, weight),..] of __search_text_keys__."""
+        if cls.__search_text_weight_type__ == 'uniform':
+            return [(key, 1) for key in cls.__search_text_keys__]
+        elif cls.__search_text_weight_type__ == 'weighted':
+            return list(cls.__search_text_keys__)
+        else:
+            raise Exception('index method must be either uniform or weighted')
+
+    @classmethod
+    def generateSearchTokens(cls, values):
+        """Generate distinct search tokens of each key with weights.
+
+        Each token is stored once for each key with the weight of the key,
+        instead of repeating the text. The key ('k') is kept so that tokens
+        of a key can be replaced when only the key is updated.
+
+        {'name': 'Some text'} (weight of name is 2)
+        -> [{'t': 'so', 'w': 2, 'k': 'name'}, {'t': 'om', 'w': 2, 'k': 'name'},..]
+
+        args:
+            values (dict): values of __search_text_keys__. keys not in values have no token.
+        """
+        if cls.__search_text_index_unit__ != 'bigram':
+            raise Exception('index unit must be bigram for tokens mode')
+        tokens = []
+        for key, weight in cls.__searchKeysAndWeights():
+            if values.get(key):
+                tokens += [{'t': token, 'w': weight, 'k': key} for token in
+                           sorted(set(cls.generateSearchBiGramStr(values[key]).lower().split()))]
+        return tokens
+
+    @classmethod
+    def __createSearchIndex(cls, db=None):
+        """Create the index for text search depending on __search_text_index_mode__."""
+        if cls.__search_text_index_mode__ == 'tokens':
+            cls._collection(db).create_index([('search_tokens.t', ASCENDING)])
+        else:
+            cls._collection(db).create_index(
+                [('search_text', TEXT)], default_language='english')
+
+    @classmethod
+    def migrateSearchTokens(cls, batch_size=1000, unset_search_text=True,
+                            drop_text_index=False, db=None):
+        """Migrate an existing collection from search_text to search_tokens.
+
+        Documents are read in _id order by batches and updated with bulk_write.
+        Set __search_text_index_mode__ = 'tokens' before calling.
+
+        args:
+            batch_size (int): # of documents updated in each bulk_write.
+            unset_search_text (bool): remove search_text from documents if True.
+            drop_text_index (bool): drop the $text index on search_text if True.
+
+        returns:
+            migrated_count (int): # of documents updated.
+        """
+        assert cls.__search_text_index_mode__ == 'tokens', \
+            '__search_text_index_mode__ must be tokens to migrate'
+        __db = db if db else cls.__db
+        collection = cls._collection(__db)
+        cls.__createSearchIndex(__db)
+        projection = {key: 1 for key, _ in cls.__searchKeysAndWeights()}
+        migrated_count = 0
+        last_id = None
+        while True:
+            query = {} if last_id is None else {'_id': {'$gt': last_id}}
+            documents = list(collection.find(query, projection)
+                             .sort('_id', ASCENDING).limit(batch_size))
+            if not documents:
+                break
+            requests = []
+            for document in documents:
+                update = {'$set': {'search_tokens': cls.generateSearchTokens(document)}}
+                if unset_search_text:
+                    update['$unset'] = {'search_text': ''}
+                requests += [UpdateOne({'_id': document['_id']}, update)]
+            migrated_count += collection.bulk_write(requests, ordered=False).modified_count
+            last_id = documents[-1]['_id']
+            logging.info('migrated search tokens: {} {}'.format(cls.__name__, migrated_count))
+        if drop_text_index:
+            for name, info in collection.index_information().items():
+                if ('search_text', TEXT) in info['key']:
+                    collection.drop_index(name)
+        return migrated_count
+
+    @classmethod
+    def refresh(cls, full=False, db=None):
+        """Refresh the summary model defined by __materialized__.
+
+        The pipeline runs over the source model and results are written by $merge.
+        Incremental refresh only runs over documents whose timestamp_key ('updated')
+        is past the watermark saved at the last refresh. MongoBase sets 'updated'
+        on updates and on inserts without it, other timestamp keys must be set
+        by the source on both:
+            - with group_key, all source documents of the changed groups are aggregated
+              so that the pipeline can be a $group.
+            - without group_key, only changed documents are aggregated.
+        Deleted source documents, documents moved to another group and documents
+        written without timestamp_key (e.g. by other clients) are reflected by a full refresh only.
+
+        args:
+            full (bool): aggregate all source documents and remove stale results if True.
+
+        returns:
+            mode (str): 'full' or 'incremental'
+        """
+        assert cls.__materialized__, '__materialized__ must be set to refresh'
+        spec = dict(DEFAULT_SPEC, **cls.__materialized__)
+        if spec['incremental'] and not spec['group_key'] and any(
+                operator in AGGREGATING_STAGES for stage in spec['pipeline'] for operator in stage):
+            # aggregates of changed documents only would replace the whole results
+            raise Exception(
+                'group_key is required for incremental refreshes of {} since the pipeline '
+                'aggregates documents. (or set incremental to False)'.format(cls.__name__))
+        __db = db if db else cls.__db
+        source = spec['source']._collection(__db)
+        watermarks = __db[WATERMARK_COLLECTION]
+        started = datetime.datetime.now(datetime.timezone.utc)
+        state = watermarks.find_one({'_id': cls.__collection__})
+        incremental = spec['incremental'] and not full and state is not None
+
+        pipeline = list(spec['pipeline'])
+        if incremental:
+            changed = {spec['timestamp_key']: {'$gt': state['watermark']}}
+            if spec['group_key']:
+                keys = source.distinct(spec['group_key'], changed)
+                pipeline = [{'$match': {spec['group_key']: {'$in': keys}}}] + pipeline if keys else None
+            else:
+                pipeline = [{'$match': changed}] + pipeline
+        if pipeline is not None:
+            pipeline += [
+                {'$addFields': {'refreshed': started}},
+                {'$merge': {
+                    'into': {'db': __db.name, 'coll': cls.__collection__},
+                    'on': '_id',
+                    'whenMatched': spec['when_matched'],
+                    'whenNotMatched': 'insert'}},
+            ]
+            # $merge returns no document
+            list(source.aggregate(pipeline))
+        if not incremental and spec['remove_stale']:
+            cls._collection(__db).delete_many({'refreshed': {'$lt': started}})
+        watermarks.update_one({'_id': cls.__collection__}, {'$set': {
+            'watermark': started - spec['watermark_lag'],
+            'refreshed': started}}, upsert=True)
+        mode = 'incremental' if incremental else 'full'
+        logging.info('refreshed: {} ({})'.format(cls.__name__, mode))
+        return mode
+
+    @classmethod
+    def scheduleRefresh(cls, interval, full=False, db=None):
+        """Call refresh() every interval seconds in a background thread.
+
+        returns:
+            scheduler (RefreshScheduler): call stop() to stop refreshing.
+        """
+        return RefreshScheduler(lambda: cls.refresh(full=full, db=db), interval)
 
     @classmethod
     def aggregate(cls, pipeline: list, should_return_generator=False, db=None):
@@ -685,9 +1964,9 @@ class MongoBase(ModelBase):
         """
         __db = db if db else cls.__db
         if should_return_generator:
-            return __db[cls.__collection__].aggregate(pipeline=pipeline)
+            return cls._collection(__db).aggregate(pipeline=pipeline)
         else:
-            return [item for item in __db[cls.__collection__].aggregate(pipeline=pipeline)]
+            return [item for item in cls._collection(__db).aggregate(pipeline=pipeline)]
 
     @classmethod
     def largestID(cls, db=None) -> int:
@@ -706,12 +1985,19 @@ class MongoBase(ModelBase):
         The wrapper of count() method in pymongo.
         """
         __db = db if db else cls.__db
-        return __db[cls.__collection__].count(query)
+        cls.__recordQuery('count', query)
+        if cls.__bucket__:
+            # buckets keep the # of documents in them
+            pipeline = [{'$group': {'_id': None, 'count': {'$sum': '$count'}}}] if not query \
+                else cls.__bucketPipeline(query) + [{'$count': 'count'}]
+            results = list(cls._collection(__db).aggregate(pipeline, allowDiskUse=True))
+            return results[0]['count'] if results else 0
+        return cls._collection(__db).count(query)
 
     @classmethod
     def incrementalId(cls, db=None) -> int:
         __db = db if db else cls.__db
-        cursor = __db[cls.__collection__].find({}, {'_id': 1})
+        cursor = cls._collection(__db).find({}, {'_id': 1})
         return cursor.sort('_id', DESCENDING).limit(1).next()['_id'] + 1\
             if int(cursor.count()) > 0 else 1
 
@@ -722,9 +2008,20 @@ class MongoBase(ModelBase):
         The wrapper of distinct() method in pymongo.
         """
         __db = db if db else cls.__db
+        if cls.__bucket__:
+            cls.__recordQuery('distinct', query)
+            pipeline = cls.__bucketPipeline(query if query else {}) + [
+                # values in arrays are distinct values like distinct().
+                # null, missing values and empty arrays are grouped as null
+                {'$unwind': {'path': '$' + key, 'preserveNullAndEmptyArrays': True}},
+                {'$group': {'_id': '$' + key}}]
+            return [result['_id'] for result in
+                    cls._collection(__db).aggregate(pipeline, allowDiskUse=True)]
         if not query:
-            return __db[cls.__collection__].distinct(key)
+            cls.__recordQuery('distinct', query)
+            return cls._collection(__db).distinct(key)
         else:
+            # recorded as 'find' by __find()
             return cls.__find(query, db=__db).distinct(key)
 
     @classmethod
@@ -737,7 +2034,8 @@ class MongoBase(ModelBase):
             writer.writerow(keys)
             for estate in cls.find(query):
                 try:
-                    values = [estate.serialize().get(key) for key in keys]
+                    serialized = estate.serialize()
+                    values = [serialized.get(key) for key in keys]
                 except Exception as e:
                     logging.debug(e)
                 else:
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# querystats.py
+#
+#
+# QUERY SHAPE RECORDING:
+# 1. set a recorder on MongoBase (or on a subclass only).
+# 2. run the application as usual.
+# 3. ask the model for index advice.
+#
+# BASIC USAGE EXAMPLE:
+#
+# MongoBase.__query_recorder__ = QueryShapeRecorder()
+# Bird.find({'name': 'chicken', 'age': {'$gte': 3}}, sort=[('created', -1)])
+# MongoBase.__query_recorder__.top(10)  # most frequent shapes
+# Bird.adviseIndexes(top=10)  # run explain() and suggest indexes
+# Bird.adviseIndexes(top=10, create=True)  # and create them
+
+import threading
+from collections import Counter
+from pymongo import ASCENDING
+
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+EQUALITY_OPERATORS = ('eq', '$eq', '$in')
+
+
+def normalize_query(query):
+    """Return the shape of a query.
+
+    Values are dropped and only keys and operators are kept.
+
+    {'name': 'chicken', 'age': {'$gte': 3, '$lt': 10}}
+    -> (('age', ('$gte', '$lt')), ('name', ('eq',)))
+
+    returns:
+        shape (tuple): hashable shape of the query.
+    """
+    if not query:
+        return ()
+    shape = []
+    for key, value in query.items():
+        if key in LOGICAL_OPERATORS:
+            branches = {normalize_query(branch) for branch in value}
+            shape.append((key, tuple(sorted(branches, key=repr))))
+        elif isinstance(value, dict) and value \
+                and all(str(op).startswith('$') for op in value):
+            shape.append((key, tuple(sorted(value))))
+        else:
+            shape.append((key, ('eq',)))
+    return tuple(sorted(shape, key=repr))
+
+
+def normalize_sort(sort):
+    """Return the shape of a sort specification.
+
+    'created' -> (('created', 1),)
+    [('created', -1), ('score', {'$meta': 'textScore'})]
+    -> (('created', -1), ('score', '$meta'))
+    """
+    if not sort:
+        return ()
+    if isinstance(sort, str):
+        return ((sort, ASCENDING),)
+    return tuple(
+        (key, '$meta' if isinstance(direction, dict) else direction)
+        for key, direction in sort)
+
+
+def plan_issues(explain):
+    """Find collection scans and in-memory sorts in an explain() result.
+
+    returns:
+        issues (tuple): (has_collection_scan (bool), has_in_memory_sort (bool))
+    """
+    stages = set()
+
+    def walk(node):
+        if isinstance(node, dict):
+            if 'stage' in node:
+                stages.add(node['stage'])
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(explain.get('queryPlanner', {}).get('winningPlan', {}))
+    return 'COLLSCAN' in stages, 'SORT' in stages
+
+
+def suggest_index(query_shape, sort_shape):
+    """Suggest an index for a shape with the equality, sort, range order.
+
+    Fields under $or and $nor are not considered since each branch
+    needs its own index.
+
+    returns:
+        index (list): [(key, direction),..] or empty list if nothing to index.
+    """
+    equality, ranges = [], []
+
+    def collect(shape):
+        for key, ops in shape:
+            if key == '$and':
+                for branch in ops:
+                    collect(branch)
+            elif key in LOGICAL_OPERATORS or key.startswith('$'):
+                continue
+            elif all(op in EQUALITY_OPERATORS for op in ops):
+                equality.append(key)
+            else:
+                ranges.append(key)
+
+    collect(query_shape)
+    index = [(key, ASCENDING) for key in equality]
+    for key, direction in sort_shape:
+        if direction != '$meta' and key not in equality:
+            index.append((key, direction))
+    for key in ranges:
+        if key not in [k for k, _ in index]:
+            index.append((key, ASCENDING))
+    # drop duplicated keys keeping the first position
+    seen = set()
+    return [(k, d) for k, d in index if not (k in seen or seen.add(k))]
+
+
+def index_keys(index):
+    """Normalize an entry of __indexes__ into [(key, direction),..]."""
+    if isinstance(index, dict):
+        index = index['keys']
+    if isinstance(index, str):
+        return [(index, ASCENDING)]
+    return [(key, direction) for key, direction in index]
+
+
+def is_covered(suggestion, indexes):
+    """Return True if suggestion is a prefix of any of indexes."""
+    for index in indexes:
+        keys = index_keys(index)
+        if keys[:len(suggestion)] == suggestion:
+            return True
+    return False
+
+
+class QueryShapeRecorder(object):
+    """Count how often each query shape is issued.
+
+    A shape is identified by the collection, the operation,
+    the normalized query and the normalized sort.
+    The first query seen for each shape is kept as a sample for explain().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._samples = {}
+
+    def record(self, collection, operation, query, sort=None):
+        shape = (collection, operation, normalize_query(query), normalize_sort(sort))
+        with self._lock:
+            self._counts[shape] += 1
+            if shape not in self._samples:
+                self._samples[shape] = (query or {}, sort)
+
+    def top(self, n=None, collection=None):
+        """Return the most frequent shapes.
+
+        returns:
+            shapes (list): [{'collection', 'operation', 'query_shape',
+                             'sort_shape', 'count', 'sample_query', 'sample_sort'},..]
+        """
+        with self._lock:
+            counts = [(shape, count) for shape, count in self._counts.most_common()
+                      if collection is None or shape[0] == collection]
+            samples = dict(self._samples)
+        return [{
+            'collection': shape[0],
+            'operation': shape[1],
+            'query_shape': shape[2],
+            'sort_shape': shape[3],
+            'count': count,
+            'sample_query': samples[shape][0],
+            'sample_sort': samples[shape][1],
+        } for shape, count in counts[:n]]
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._samples.clear()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# readahead.py
+#
+#
+# READ AHEAD:
+# fetch and hydrate the next batches in a background thread
+# while the consumer works on the current one.
+#
+# BASIC USAGE EXAMPLE:
+#
+# for bird in Bird.find({}, returns_generator=True, read_ahead=2, batch_size=1000):
+#     do_something(bird)  # the next 2 batches are loaded meanwhile
+#
+# with ReadAheadIterator(Bird.find({}, returns_generator=True)) as birds:
+#     for bird in birds:
+#         if bird.age > 10:
+#             break  # the background thread stops here
+
+import queue
+import threading
+
+_END = object()
+
+
+def _put(batches, stop, item):
+    """Put item to batches unless stopped. returns False if stopped."""
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _load(iterable, batches, stop, batch_size):
+    """Load items of iterable to batches. (run in the background thread)
+
+    This doesn't refer to the ReadAheadIterator so that it can be garbage collected
+    when the consumer stops early.
+    """
+    batch = []
+    try:
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                if not _put(batches, stop, batch):
+                    return
+                batch = []
+        if batch and not _put(batches, stop, batch):
+            return
+        _put(batches, stop, _END)
+    except BaseException as e:
+        _put(batches, stop, e)
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close:
+            close()
+
+
+class ReadAheadIterator(object):
+    """Iterate items of an iterable loaded by a background thread.
+
+    At most max_batches batches of batch_size items are kept ahead of
+    the consumer. Exceptions in the background thread are raised to the consumer.
+    The thread stops when the iterator is exhausted, closed or garbage collected.
+
+    args:
+        iterable (iterable): e.g. a generator of instances from a cursor.
+        batch_size (int): # of items passed to the consumer at once.
+        max_batches (int): max # of batches loaded ahead.
+    """
+    def __init__(self, iterable, batch_size=1000, max_batches=2):
+        self._closed = False
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._stop = threading.Event()
+        self._batch = iter(())
+        self._thread = threading.Thread(
+            target=_load, args=(iterable, self._queue, self._stop, batch_size), daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for item in self._batch:
+            return item
+        if self._closed:
+            raise StopIteration
+        batch = self._queue.get()
+        if batch is _END:
+            self.close()
+            raise StopIteration
+        if isinstance(batch, BaseException):
+            self.close()
+            raise batch
+        self._batch = iter(batch)
+        return next(self._batch)
+
+    def close(self):
+        """Stop the background thread and drop loaded batches."""
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        self._batch = iter(())
+        # unblock the thread waiting for a free slot
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if hasattr(self, '_thread'):
+            self.close()
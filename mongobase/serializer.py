@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# serializer.py
+#
+#
+# BULK JSON SERIALIZATION:
+# encode many ModelBase instances at once into json bytes
+# without creating intermediate dicts like serialize() does.
+#
+# BASIC USAGE EXAMPLE:
+#
+# Bird.serializeMany(Bird.find({}, returns_generator=True))  # -> b'[{...},..]'
+# with open('birds.json', 'wb') as fp:
+#     Bird.serializeMany(Bird.find({}, returns_generator=True), fp=fp)
+#
+# serializer = JSONSerializer(Bird, encoders={
+#     datetime.datetime: lambda d: d.isoformat(),
+# })
+# serializer.encode(birds)
+
+import datetime
+import json
+import math
+from json.encoder import encode_basestring_ascii
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from .fields import LazyField
+
+# same as the separators of top level fields
+_SEPARATORS = (',', ':')
+
+DEFAULT_ENCODERS = {
+    datetime.datetime: lambda value: datetime.datetime.strftime(value, '%Y/%m/%d/%H/%M/%S'),
+    ObjectId: str,
+    Decimal128: str,
+}
+
+
+def _encode_float(value):
+    if math.isfinite(value):
+        return float.__repr__(value)
+    return json.dumps(value)
+
+
+class JSONSerializer(object):
+    """Json encoder compiled from __structure__ of a ModelBase subclass.
+
+    Key names are encoded once and each field gets an encoder selected
+    by the type declared in __structure__.
+
+    args:
+        model (ModelBase subclass): the model to be serialized.
+        encoders (dict): pairs like type: func(value) to override DEFAULT_ENCODERS.
+            the returned value is encoded as json. (optional)
+    """
+    def __init__(self, model, encoders=None):
+        self.model = model
+        self.encoders = dict(DEFAULT_ENCODERS)
+        if encoders:
+            self.encoders.update(encoders)
+        self._dispatch = {
+            str: encode_basestring_ascii,
+            bool: lambda value: 'true' if value else 'false',
+            int: int.__repr__,
+            float: _encode_float,
+        }
+        for value_type, encoder in self.encoders.items():
+            self._dispatch[value_type] = self._wrap(encoder)
+        self._fields = [
+            (key, encode_basestring_ascii(key) + ':', self._field_encoder(declared))
+            for key, declared in model.__structure__.items()
+            if not isinstance(declared, LazyField)
+        ]
+        # LazyField values are decoded by the field
+        self._lazy_fields = [
+            (key, encode_basestring_ascii(key) + ':', declared.jsonValue)
+            for key, declared in model.__structure__.items()
+            if isinstance(declared, LazyField)
+        ]
+
+    def _wrap(self, encoder):
+        def encode(value):
+            result = encoder(value)
+            if isinstance(result, str):
+                return encode_basestring_ascii(result)
+            return json.dumps(result, separators=_SEPARATORS, default=self._default)
+        return encode
+
+    def _default(self, value):
+        """Used by json.dumps() for values nested in lists or dicts."""
+        for value_type, encoder in self.encoders.items():
+            if isinstance(value, value_type):
+                return encoder(value)
+        raise TypeError(
+            'Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+    def _encode_value(self, value):
+        if value is None:
+            return 'null'
+        encoder = self._dispatch.get(value.__class__)
+        if encoder is not None:
+            return encoder(value)
+        return json.dumps(value, separators=_SEPARATORS, default=self._default)
+
+    def _field_encoder(self, declared):
+        fast = self._dispatch.get(declared)
+        if fast is None:
+            return self._encode_value
+        encode_value = self._encode_value
+
+        def encode(value):
+            if value.__class__ is declared:
+                return fast(value)
+            return encode_value(value)
+        return encode
+
+    def encodeOne(self, obj):
+        """Return a json string of an instance."""
+        get = obj.get
+        values = [prefix + encode(get(key)) for key, prefix, encode in self._fields]
+        if self._lazy_fields:
+            encode_value = self._encode_value
+            values += [prefix + encode_value(json_value(obj, key) if key in obj else None)
+                       for key, prefix, json_value in self._lazy_fields]
+        return '{' + ','.join(values) + '}'
+
+    def iterencode(self, instances, chunk_size=1000):
+        """Yield json bytes of a list of instances chunk by chunk.
+
+        args:
+            instances (iterable): ModelBase instances or dicts.
+            chunk_size (int): # of instances encoded in each chunk.
+        """
+        encode_one = self.encodeOne
+        chunk = []
+        separator = '['
+        for obj in instances:
+            chunk.append(separator + encode_one(obj))
+            separator = ','
+            if len(chunk) >= chunk_size:
+                yield ''.join(chunk).encode('ascii')
+                chunk = []
+        if separator == '[':
+            chunk.append('[')
+        chunk.append(']')
+        yield ''.join(chunk).encode('ascii')
+
+    def encode(self, instances):
+        """Return json bytes of a list of instances."""
+        return b''.join(self.iterencode(instances))
+
+    def dump(self, instances, fp, chunk_size=1000):
+        """Write json bytes of a list of instances to a binary file-like object.
+
+        returns:
+            written (int): # of bytes written.
+        """
+        written = 0
+        for chunk in self.iterencode(instances, chunk_size=chunk_size):
+            fp.write(chunk)
+            written += len(chunk)
+        return written
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# throttle.py
+#
+#
+# THROTTLING:
+# keep long running batch operations under a target rate.
+#
+# BASIC USAGE EXAMPLE:
+#
+# limiter = RateLimiter(max_rate=5000)  # 5000 operations per second
+# for batch in batches:
+#     do_something(batch)
+#     limiter.wait(len(batch))  # sleep if it's faster than max_rate
+
+import time
+
+
+class RateLimiter(object):
+    """Sleep to keep the average # of operations per second under max_rate.
+
+    args:
+        max_rate (float): max # of operations per second. no limit if None.
+    """
+    def __init__(self, max_rate=None):
+        self.max_rate = max_rate
+        self.started = time.monotonic()
+        self.count = 0
+
+    def wait(self, count):
+        """Count operations and sleep if they are faster than max_rate.
+
+        returns:
+            slept (float): seconds slept.
+        """
+        self.count += count
+        if not self.max_rate:
+            return 0.0
+        expected = self.started + self.count / self.max_rate
+        delay = expected - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0.0
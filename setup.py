@@ -16,7 +16,7 @@ setuptools.setup(
     license="MIT",
     keywords=["mongodb", "mongo", "pymongo", "orm", "or mapper"],
     packages=setuptools.find_packages(),
-    install_requires=["pymongo>=3.6.0"],
+    install_requires=["pymongo>=3.9.0"],
     python_requires='~=3.6',
     classifiers=[
         "License :: OSI Approved :: MIT License",